@@ -0,0 +1,254 @@
+'''Render benchmarks for the hot paths of the client
+
+Everything is drawn onto off-screen consoles, so no window is needed and the numbers don't include
+waiting for vsync. Every benchmark draws a number of frames after warming up, and reports the
+distribution of the frame times, how much memory a frame allocates at its peak and how many blocks
+it leaves allocated.
+
+Save a baseline once, then compare later runs against it:
+
+    python benchmarks.py --save benchmarks.json
+    python benchmarks.py --baseline benchmarks.json
+
+Any benchmark whose median frame time got slower than the baseline by more than the tolerance
+makes the run fail.
+'''
+
+import argparse
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+
+import tcod.console
+
+import constants
+from components import particle
+from components.render import Background
+from components.ui import Button, Input, Menu, Textbox
+
+MIST = {
+    'fade': 0.0000000001,
+    'col': (2, 4, 8),
+    'length': 25,
+    'height': 5,
+    'vx': (-5, 5),
+    'vy': (-4, -1),
+    'life': 200
+}
+
+RAIN = {
+    'fade': 0.0005,
+    'col': (20, 20, 40),
+    'vx': (-100, -80),
+    'vy': (70, 100),
+    'life': 90,
+    'height': 2
+}
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Register a benchmark, a function setting up and returning the function drawing one frame."""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def root_console():
+    return tcod.console.Console(constants.SCREEN_WIDTH, constants.SCREEN_HEIGHT, order='F')
+
+
+@benchmark
+def background():
+    console = root_console()
+    bg = Background('Benchmark')
+    return lambda: bg.draw(console)
+
+
+@benchmark
+def background_uncached():
+    console = root_console()
+    bg = Background('Benchmark')
+
+    def frame():
+        bg.set_theme(bg.theme)
+        bg.draw(console)
+    return frame
+
+
+@benchmark
+def particles():
+    console = root_console()
+    emitters = [
+        particle.Emitter(console, MIST, 1, console.height - 1, console.width - 23, 1),
+        particle.Emitter(console, RAIN, 1, 0, console.width - 2, 1, rate=3)
+    ]
+
+    def frame():
+        console.clear()
+        for emitter in emitters:
+            emitter.create_particle()
+            emitter.draw()
+
+    # Run until as many particles are dying as are being created
+    for _ in range(MIST['life']):
+        frame()
+    return frame
+
+
+@benchmark
+def textbox():
+    console = root_console()
+    box = Textbox(tcod.console.Console(constants.SCREEN_WIDTH - 4, constants.SCREEN_HEIGHT // 3))
+    for i in range(500):
+        box.add_message('player%d: %s' % (i % 7, 'lorem ipsum dolor sit amet ' * (1 + i % 5)))
+    box.scroll_offset = 0
+    count = [0]
+
+    def frame():
+        # Scroll a line every frame so the visible lines keep changing
+        count[0] += 1
+        box.scroll_offset = count[0] % (len(box.log) - box.page_size)
+        box.draw(console)
+    return frame
+
+
+@benchmark
+def menu():
+    console = root_console()
+    contents = [Input('IP:  ', '127.0.0.1'), Input('Port:', '7777'), Button('Connect'), Button('Cancel')]
+    m = Menu.create(console, contents, title='Connect to Server')
+
+    def frame():
+        m.pack()
+        m.draw(console)
+    return frame
+
+
+@benchmark
+def chat_view():
+    from main import ChatView
+    console = root_console()
+    view = ChatView(None)
+    for i in range(200):
+        view.message_box.add_message('player%d: message number %d' % (i % 7, i))
+    return lambda: view.draw(console)
+
+
+@benchmark
+def frame():
+    """The whole client screen, with every layer rendered again every frame."""
+    from main import Game
+    from components.map import Map
+    console = root_console()
+    game = Game(console)
+    game.game_client.map = Map('benchmark')
+    for i in range(200):
+        game.chat_view.message_box.add_message('player%d: message number %d' % (i % 7, i))
+
+    def frame():
+        game.compositor.mark_dirty()
+        game.compositor.draw(console)
+    return frame
+
+
+@benchmark
+def frame_idle():
+    """The whole client screen when nothing changed since the last frame."""
+    from main import Game
+    console = root_console()
+    game = Game(console)
+    return lambda: game.compositor.draw(console)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def run(name, frames, warmup):
+    draw = BENCHMARKS[name]()
+    for _ in range(warmup):
+        draw()
+
+    times = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        draw()
+        times.append(time.perf_counter() - start)
+    times.sort()
+
+    # Separate run, tracing allocations slows everything down. Tracing starts over for every frame,
+    # so the peak and the snapshot only hold what that frame allocated.
+    peaks = []
+    blocks = []
+    for _ in range(min(frames, 50)):
+        tracemalloc.start()
+        draw()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        # Whatever the frame allocated and is still around
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        blocks.append(sum(stat.count for stat in snapshot.statistics('filename')))
+
+    return {
+        'mean': statistics.mean(times) * 1000,
+        'p50': percentile(times, 50) * 1000,
+        'p95': percentile(times, 95) * 1000,
+        'p99': percentile(times, 99) * 1000,
+        'alloc_kib': statistics.median(peaks) / 1024,
+        'blocks': statistics.median(blocks),
+        'retained': sum(blocks)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the client render hot paths.')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all by default: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=30)
+    parser.add_argument('--save', metavar='FILE', help='write the results to FILE as the new baseline')
+    parser.add_argument('--baseline', metavar='FILE', help='compare against the results saved in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='how much slower than the baseline the median may get, 0.25 is 25%%')
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(sorted(unknown)))
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    failed = []
+    print('%-20s %9s %9s %9s %9s %10s %8s %8s' % ('ms', 'mean', 'p50', 'p95', 'p99', 'alloc KiB', 'blocks',
+                                                  'retained'))
+    for name in args.names or BENCHMARKS:
+        result = results[name] = run(name, args.frames, args.warmup)
+        line = '%-20s %9.3f %9.3f %9.3f %9.3f %10.1f %8d %8d' % (
+            name, result['mean'], result['p50'], result['p95'], result['p99'], result['alloc_kib'], result['blocks'],
+            result['retained'])
+
+        before = baseline.get(name)
+        if before is not None:
+            change = result['p50'] / before['p50'] - 1
+            line += '  %+6.1f%%' % (change * 100)
+            if change > args.tolerance:
+                line += '  SLOWER'
+                failed.append(name)
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if failed:
+        print('\n%d benchmark(s) slower than the baseline: %s' % (len(failed), ', '.join(failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
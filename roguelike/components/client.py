@@ -4,21 +4,51 @@ This module is responsible for handling network events on the client sides
 
 """
 
-import components.net_utils
+import collections
+import queue
 import socket
+import time
+
+import components.net_utils
 import constants
 
+from components.game import Action
+from components.log import get_logger, Truncated
+from components.map import Map
+from components.prediction import Prediction
+from components.snapshots import SnapshotReceiver
+
 from threading import Thread
 
-logger = components.net_utils.get_logger()
+logger = get_logger('client')
 
 
 class Client:
+    """Connection to the server, handing what comes in to the main loop.
+
+    The network thread only decodes messages and puts them in a bounded inbox, when it's full the
+    thread waits, which lets TCP slow down the server. Everything else, like updating the map and
+    telling the listeners, happens in process_events on the thread calling it, once per frame.
+    """
 
-    def __init__(self):
+    def __init__(self, inbox_size=1024):
         self.connected = False
         self.socket = socket.socket()
         self.connection_event_listeners = []
+        self.codec = components.net_utils.JSON
+        self.name = None
+        # Given by the server when we connect, unlike the name it's unique
+        self.id = None
+        # Map of the session we're in, kept up to date by MAP_DELTA messages
+        self.map = None
+        # Where we expect everyone to be in the session we're playing in
+        self.prediction = None
+        # The characters around us as the server last reported them
+        self.world = SnapshotReceiver()
+        self.started = False
+        self.inbox = queue.Queue(inbox_size)
+        # Events taken from the inbox that didn't fit in the last frame's budget
+        self._backlog = collections.deque()
 
     def connect(self, host, port):
         # TODO error handling
@@ -40,19 +70,127 @@ class Client:
         self.socket.close()
 
     def send(self, message):
-        components.net_utils.send(self.socket, message)
+        components.net_utils.send(self.socket, message, self.codec)
 
     def on_message_received(self, sock, message):
-        self.send_connection_event(message)
-        print(message)
-        logger.debug('client mss reveived')
+        # Switched right away, messages we send from here on can use it
+        if message[0] == constants.PLAYER_CONNECT:
+            self.codec = components.net_utils.CODECS[message[1]['codec']]
+        self.inbox.put(message)
+        logger.debug('received %s', Truncated(message))
 
     def on_disconnect(self, _):
-        self.send_connection_event((constants.SERVER, {'message': 'The server has disconnected'}))
+        try:
+            self.inbox.put_nowait((constants.SERVER, {'message': 'The server has disconnected'}))
+        except queue.Full:
+            # Nobody is emptying the inbox, most likely the window was closed
+            pass
         logger.debug('Server disconnected')
 
+    def process_events(self, budget=0.004, limit=256):
+        """Handle what came in since the last call, spending at most about budget seconds on it.
+
+        Returns the number of events handled, what doesn't fit is left for the next call.
+        """
+        while len(self._backlog) < limit:
+            try:
+                self._backlog.append(self.inbox.get_nowait())
+            except queue.Empty:
+                break
+        events = self.coalesce(self._backlog)
+        self._backlog.clear()
+
+        deadline = time.perf_counter() + budget
+        for handled, event in enumerate(events):
+            if handled and time.perf_counter() > deadline:
+                self._backlog.extend(events[handled:])
+                return handled
+            self._handle_event(event)
+        return len(events)
+
+    @staticmethod
+    def coalesce(events) -> list:
+        """Merge events that can be handled at once.
+
+        A full map makes every map message before it pointless, and resolves following each other
+        are merged into one, so predictions are replayed once.
+        """
+        events = list(events)
+        maps = [i for i, event in enumerate(events) if event[0] == constants.MAP]
+        if maps:
+            events = [event for i, event in enumerate(events)
+                      if i >= maps[-1] or event[0] not in (constants.MAP, constants.MAP_DELTA)]
+
+        merged = []
+        for event in events:
+            if event[0] == constants.PLAYER_RESOLVE and merged and merged[-1][0] == constants.PLAYER_RESOLVE:
+                previous = merged[-1][1]
+                merged[-1] = (constants.PLAYER_RESOLVE, {
+                    'tick': event[1]['tick'],
+                    'results': previous['results'] + event[1]['results'],
+                    'acks': dict(previous.get('acks', {}), **event[1].get('acks', {}))
+                })
+            else:
+                merged.append(event)
+        return merged
+
+    def _handle_event(self, message):
+        if message[0] == constants.PLAYER_CONNECT:
+            self.id = message[1].get('id')
+        elif message[0] == constants.MAP:
+            self._set_map(Map.from_snapshot(message[1]))
+        elif message[0] == constants.MAP_DELTA:
+            self._apply_map_delta(message[1])
+        elif message[0] == constants.LOBBIES and message[1].get('start'):
+            self.started = True
+        elif message[0] == constants.PLAYER_RESOLVE and self.prediction is not None:
+            self.prediction.reconcile(message[1])
+        elif message[0] == constants.SNAPSHOT:
+            self._apply_snapshot(message[1])
+        self.send_connection_event(message)
+
+    def move(self, dx, dy):
+        """Move our character, shown right away and sent to the server to confirm."""
+        if not self.started or self.prediction is None:
+            return
+        position = self.prediction.position()
+        if position is None:
+            return
+        target = [position[0] + dx, position[1] + dy]
+        seq = self.prediction.predict(Action('MOVE', target))
+        self.send((constants.PLAYER_INTENT, {
+            'id': self.map.session_id,
+            'seq': seq,
+            'action': {'type': 'MOVE', 'value': target}
+        }))
+
+    def _set_map(self, game_map):
+        if self.prediction is None or self.map is None or self.map.session_id != game_map.session_id:
+            self.prediction = Prediction(self.id, game_map)
+            self.world = SnapshotReceiver()
+            self.started = False
+        else:
+            self.prediction.state.map = game_map
+        self.map = game_map
+
+    def _apply_map_delta(self, delta):
+        if self.map is not None and self.map.apply_delta(delta):
+            return
+        # We missed a delta somewhere, ask for everything after the version we do have
+        version = self.map.version if self.map is not None else -1
+        self.send((constants.MAP_RESYNC, {'session_id': delta['session_id'], 'version': version}))
+
+    def _apply_snapshot(self, snapshot):
+        if self.map is None or snapshot['session_id'] != self.map.session_id:
+            return
+        # One we can't apply isn't acknowledged, so the server keeps sending against an older baseline
+        if self.world.apply(snapshot):
+            if self.prediction is not None:
+                self.prediction.observe(self.world.state)
+            self.send((constants.SNAPSHOT_ACK, {'session_id': snapshot['session_id'], 'tick': snapshot['tick']}))
+
     def _run_message_listener(self):
-        # logger.debug('client mss reveived')
         listener = components.net_utils.MessageListener(self.socket, self)
-        t = Thread(target=listener.listen)
+        # A daemon, so a listener waiting for room in the inbox doesn't keep the game from exiting
+        t = Thread(target=listener.listen, daemon=True)
         t.start()
@@ -0,0 +1,42 @@
+'''Field of view module working out which tiles can be seen from where
+
+Computing a field of view walks every tile around the viewer, so results are cached per viewer
+position and only thrown away when the map changes.
+'''
+
+import numpy as np
+import tcod.map
+
+import constants as c
+
+
+class FieldOfView:
+    """Cached fields of view on a map, for viewers seeing up to radius tiles far.
+
+    Results are (height, width) bool arrays indexed [y, x], True where a tile can be seen. They're
+    shared between everyone asking from the same position, so don't change them.
+    """
+
+    def __init__(self, game_map, radius=c.FOV_RADIUS, cache_size=1024):
+        self.map = game_map
+        self.radius = radius
+        self.cache_size = cache_size
+        self._cache = {}
+        self._version = game_map.version
+
+    def visible(self, x, y) -> np.ndarray:
+        if self._version != self.map.version:
+            self._cache.clear()
+            self._version = self.map.version
+
+        mask = self._cache.get((x, y))
+        if mask is None:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            mask = tcod.map.compute_fov(self.map.transparent, (y, x), self.radius)
+            mask.flags.writeable = False
+            self._cache[(x, y)] = mask
+        return mask
+
+    def can_see(self, x, y, target_x, target_y):
+        return bool(self.visible(x, y)[target_y, target_x])
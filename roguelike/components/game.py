@@ -6,8 +6,12 @@ For now this module contains a rudimentary loop switching turns between players.
 '''
 
 from typing import List
+
+import numpy as np
 import tcod.console
 
+from components.spatial import SpatialIndex
+
 class Map:
     tiles = [
         []
@@ -18,6 +22,19 @@ class Action():
     value = None
     type = None
 
+    def __init__(self, type=None, value=None):
+        self.type = type
+        self.value = value
+
+
+def is_step(entity, value) -> bool:
+    """Whether value is an [x, y] pair of ints one tile away from the entity, diagonally included."""
+    if not isinstance(value, (list, tuple)) or len(value) != 2:
+        return False
+    if not all(isinstance(v, (int, np.integer)) and not isinstance(v, bool) for v in value):
+        return False
+    return max(abs(value[0] - entity.x), abs(value[1] - entity.y)) == 1
+
 
 class Entity(object):
 
@@ -34,28 +51,137 @@ class Entity(object):
 
 class Player:
 
-    def __init__(self, name, col):
+    def __init__(self, name, col, player_id=None):
         self.name = name
+        # What results are reported by, the name isn't unique
+        self.id = player_id
         self.col = col
         self.entity = Entity(5, 5, '@', col)
 
 
 class GameState:
     turncount: int = 0
-    players: List[Player] = []
+    players: List[Player]
     current_player: Player = None
 
+    def __init__(self, game_map=None):
+        # Without a map moves aren't checked against walls or the edges of the dungeon
+        self.map = game_map
+        self.players = []
+        self.entities = SpatialIndex()
+
+    def add_player(self, player: Player, spawn=True):
+        """Add a player, moved to the nearest free tile when spawning, or right where it is otherwise."""
+        if spawn and self.map is not None:
+            player.entity.x, player.entity.y = self._free_tile_near(player.entity.x, player.entity.y)
+        self.players.append(player)
+        self.entities.insert(player.entity)
+
+    def remove_player(self, player: Player):
+        self.players.remove(player)
+        self.entities.remove(player.entity)
+        if self.current_player is player:
+            self.current_player = self.players[0] if self.players else None
+
+    def occupied(self) -> np.ndarray:
+        """Return a (height, width) mask of the tiles an entity is standing on."""
+        occupied = np.zeros(self.map.tiles.shape, dtype=bool)
+        for entity in self.entities.in_rect(0, 0, self.map.width - 1, self.map.height - 1):
+            occupied[entity.y, entity.x] = True
+        return occupied
+
+    def entities_in_view(self, visible: np.ndarray, x, y, radius) -> list:
+        """Return the entities on tiles of a field of view of radius around (x, y)."""
+        return [e for e in self.entities.in_rect(x - radius, y - radius, x + radius, y + radius)
+                if self.map.in_bounds(e.x, e.y) and visible[e.y, e.x]]
+
+    def move_entity(self, entity: Entity, x, y):
+        """Move an entity, keeping the spatial index up to date."""
+        entity.x, entity.y = x, y
+        self.entities.move(entity, x, y)
+
+    def _free_tile_near(self, x, y):
+        free = self.map.walkable & ~self.occupied()
+        ys, xs = np.nonzero(free)
+        if not len(xs):
+            return x, y
+        nearest = np.argmin(np.maximum(abs(xs - x), abs(ys - y)))
+        return int(xs[nearest]), int(ys[nearest])
+
     def start(self):
         if len(self.players) > 0:
             self.current_player = self.players[0]
 
     def take_turn(self, action: Action):
         if action.type == 'MOVE':
-            self.current_player.entity.x = action.value[0]
-            self.current_player.entity.y = action.value[1]
+            self.move_entity(self.current_player.entity, action.value[0], action.value[1])
         self.turncount += 1
         self.current_player = self.players[self.turncount % len(self.players)]
 
+    def resolve(self, actions) -> list:
+        """Apply a batch of (player, action) pairs collected during one tick.
+
+        Moves are resolved as if everyone moves at once, validated with a few array lookups no matter
+        how many players there are. Every player gets one step to a neighbouring tile per tick, any
+        other move, including a second one, is refused without affecting anyone else's.
+        Returns the outcome of every action, ready to be sent to the clients.
+        """
+        moves = [(player, action.value) for player, action in actions if action.type == 'MOVE']
+        ok = np.zeros(len(moves), dtype=bool)
+        steps = []
+        moved = set()
+        for i, (player, value) in enumerate(moves):
+            if player not in moved and is_step(player.entity, value):
+                steps.append(i)
+            moved.add(player)
+
+        if steps:
+            movers = [moves[i][0] for i in steps]
+            targets = np.array([moves[i][1] for i in steps], dtype=int)
+            ok[steps] = self.validate_moves(movers, targets)
+            for player, (x, y), allowed in zip(movers, targets.tolist(), ok[steps].tolist()):
+                if allowed:
+                    self.move_entity(player.entity, x, y)
+
+        self.turncount += 1
+        return [{'player': player.id, 'type': 'MOVE', 'ok': allowed, 'x': player.entity.x, 'y': player.entity.y}
+                for (player, _), allowed in zip(moves, ok.tolist())]
+
+    def validate_moves(self, movers, targets: np.ndarray) -> np.ndarray:
+        """Check simultaneous moves of distinct players to the (x, y) rows of targets.
+
+        A move is refused when its target is off the map, not walkable, wanted by another mover as
+        well, or taken by someone who isn't moving away. Returns a bool array with one entry per move.
+        """
+        x, y = targets[:, 0], targets[:, 1]
+        if self.map is None:
+            return np.ones(len(movers), dtype=bool)
+
+        height, width = self.map.tiles.shape
+        ok = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        ok[ok] = self.map.walkable[y[ok], x[ok]]
+        target_cells = np.where(ok, y * width + x, 0)
+        contested = np.bincount(target_cells[ok], minlength=width * height) > 1
+        ok &= ~contested[target_cells]
+
+        # Everyone staying where they are blocks their tile, and every refused mover stays where they are,
+        # so keep refusing moves into the tiles of refused movers until nothing changes
+        mover_index = {player: i for i, player in enumerate(movers)}
+        positions = np.array([(p.entity.x, p.entity.y) for p in self.players], dtype=int).reshape(-1, 2)
+        moving = np.zeros(len(self.players), dtype=bool)
+        entity_move = np.array([mover_index.get(p, -1) for p in self.players], dtype=int)
+        while True:
+            moving[:] = False
+            has_move = entity_move >= 0
+            moving[has_move] = ok[entity_move[has_move]]
+            occupied = np.zeros(width * height, dtype=bool)
+            staying = positions[~moving]
+            occupied[staying[:, 1] * width + staying[:, 0]] = True
+            blocked = ok & occupied[target_cells]
+            if not blocked.any():
+                return ok
+            ok &= ~blocked
+
     def draw_state(self, console):
         for player in self.players:
             player.entity.draw(console)
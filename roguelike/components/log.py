@@ -0,0 +1,136 @@
+'''Log module setting up logging that stays off the threads doing the actual work
+
+Records are put on a queue and written to the file by a background thread, so no thread handling
+connections or ticking sessions ever waits on the disk. Every subsystem logs to its own logger
+under roguelike, which can get its own level. Anything below the level of its logger costs no more
+than the level check, so per message debug logging can stay in the code:
+
+    logger.debug('received %s', Truncated(message))
+
+Until setup is called only warnings and errors are shown, on stderr.
+'''
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import reprlib
+import threading
+import time
+
+ROOT = 'roguelike'
+FORMAT = '%(asctime)s %(levelname)s %(name)s %(message)s'
+DATE_FORMAT = '%d/%m/%Y %I:%M:%S %p'
+
+# Subsystems whose debug records come once per message, those are rate limited
+HOT_SUBSYSTEMS = ('net', 'client', 'sessions')
+
+_listener = None
+
+
+def get_logger(subsystem) -> logging.Logger:
+    return logging.getLogger(ROOT + '.' + subsystem)
+
+
+class Truncated:
+    """Wraps a payload so it's only turned into a string when a record is actually written, cut short.
+
+    Nested containers are summarised by reprlib, so even huge payloads take little time to format.
+    """
+
+    __slots__ = ('value', 'limit')
+
+    _repr = reprlib.Repr()
+    _repr.maxlevel = 3
+    _repr.maxstring = 60
+    _repr.maxother = 60
+
+    def __init__(self, value, limit=200):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        text = self._repr.repr(self.value)
+        if len(text) > self.limit:
+            text = text[:self.limit] + '...'
+        return text
+
+
+class RateLimit(logging.Filter):
+    """Lets through at most per_second records below warning for every message, drops the rest.
+
+    Messages are told apart by their format string, not the formatted text. The first record let
+    through after some were dropped says how many.
+    """
+
+    def __init__(self, per_second=10):
+        super().__init__()
+        self.per_second = per_second
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        now = int(time.monotonic())
+        with self._lock:
+            second, count, dropped = self._windows.get(record.msg, (now, 0, 0))
+            if second != now:
+                second, count = now, 0
+            if count >= self.per_second:
+                self._windows[record.msg] = (second, count, dropped + 1)
+                return False
+            self._windows[record.msg] = (second, count + 1, 0)
+        if dropped:
+            record.msg = '%s (%d similar dropped)' % (record.msg, dropped)
+        return True
+
+
+def parse_levels(specs) -> dict:
+    """Turn strings like net=DEBUG into a dictionary of levels by subsystem."""
+    levels = {}
+    for spec in specs:
+        subsystem, _, level = spec.partition('=')
+        levels[subsystem.strip()] = level.strip().upper()
+    return levels
+
+
+def setup(filename, level='INFO', levels=None, rate_limit=10):
+    """Write the roguelike loggers to filename through a background thread.
+
+    level applies to every subsystem, levels overrides it per subsystem, like {'net': 'DEBUG'}.
+    Calling setup again replaces the earlier configuration.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    handler = logging.FileHandler(filename)
+    handler.setFormatter(logging.Formatter(FORMAT, DATE_FORMAT))
+    records = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+
+    root = logging.getLogger(ROOT)
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    root.propagate = False
+
+    for subsystem in HOT_SUBSYSTEMS:
+        logger = get_logger(subsystem)
+        for old in [f for f in logger.filters if isinstance(f, RateLimit)]:
+            logger.removeFilter(old)
+        if rate_limit:
+            logger.addFilter(RateLimit(rate_limit))
+    for subsystem, subsystem_level in (levels or {}).items():
+        get_logger(subsystem).setLevel(subsystem_level)
+
+    _listener.start()
+    return _listener
+
+
+@atexit.register
+def _flush():
+    if _listener is not None:
+        _listener.stop()
@@ -1,4 +1,10 @@
-import json
+import collections
+import itertools
+
+import numpy as np
+
+import constants
+from components import net_utils
 
 test_map = [
     ['#', '#', '#', '#', '#', '#', '#', '#', '#', '#', '#', '#', '#', '#', '#', '#', '#'],
@@ -15,15 +21,119 @@ test_map = [
 ]
 
 
+# Tile ids index into these tables
+FLOOR = 0
+WALL = 1
+
+TILE_CHARS = np.array([ord(' '), ord('#')], dtype=np.uint8)
+WALKABLE = np.array([True, False])
+TRANSPARENT = np.array([True, False])
+
+_TILE_IDS = np.zeros(256, dtype=np.uint8)
+_TILE_IDS[TILE_CHARS] = np.arange(len(TILE_CHARS))
+
+
+def tiles_from_chars(rows) -> np.ndarray:
+    """Convert rows of tile characters into a (height, width) array of tile ids."""
+    chars = np.array([[ord(char) for char in row] for row in rows], dtype=np.uint8)
+    return _TILE_IDS[chars]
+
+
 class Map:
-    tiles = [[]]
+    """Dungeon map stored as a (height, width) uint8 array of tile ids, indexed [y, x].
 
-    def __init__(self, dungeon_id):
-        self.tiles = test_map
+    Walkability and transparency masks are kept next to the tiles. Every change bumps version,
+    which invalidates the cached serialized form and the encoded MAP frames. The last changes are
+    kept around so clients can be brought up to date with a delta instead of the whole map.
+    """
+
+    def __init__(self, dungeon_id, session_id=None, rows=test_map, history=1024):
         self.dungeon_id = dungeon_id
+        self.session_id = session_id
+        self.tiles = tiles_from_chars(rows)
+        self.walkable = WALKABLE[self.tiles]
+        self.transparent = TRANSPARENT[self.tiles]
+        self.version = 0
+
+        self._changes = collections.deque(maxlen=history)
+        self._serialized = None
+        self._frames = {}
+        self._frames_version = 0
+
+    @classmethod
+    def from_snapshot(cls, payload):
+        """Build a map from a MAP payload, the client side counterpart of serialize."""
+        game_map = cls(payload['dungeon_id'], payload.get('session_id'), payload['tiles'])
+        game_map.version = payload['version']
+        game_map._frames_version = game_map.version
+        return game_map
+
+    @property
+    def width(self):
+        return self.tiles.shape[1]
+
+    @property
+    def height(self):
+        return self.tiles.shape[0]
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def set_tile(self, x, y, tile):
+        if self.tiles[y, x] == tile:
+            return
+        self.tiles[y, x] = tile
+        self.walkable[y, x] = WALKABLE[tile]
+        self.transparent[y, x] = TRANSPARENT[tile]
+        self.version += 1
+        self._changes.append((x, y))
+        self._serialized = None
+
+    def changes_since(self, version):
+        """Return the coordinates changed after version, or None when the history doesn't go back that far."""
+        behind = self.version - version
+        if behind < 0 or behind > len(self._changes):
+            return None
+        # Each change is one version, so the newest ones are exactly the ones we're missing
+        return set(itertools.islice(reversed(self._changes), behind))
+
+    def tile_delta(self, version, coordinates):
+        """Build a MAP_DELTA payload taking a client at version to the current version with the tiles at coordinates."""
+        return {
+            'session_id': self.session_id,
+            'from': version,
+            'version': self.version,
+            'tiles': [[x, y, chr(TILE_CHARS[self.tiles[y, x]])] for x, y in sorted(coordinates)]
+        }
+
+    def apply_delta(self, payload) -> bool:
+        """Apply a MAP_DELTA payload, returns False if it doesn't follow on our version and a resync is needed."""
+        if payload['from'] != self.version:
+            return False
+        for x, y, char in payload['tiles']:
+            self.set_tile(x, y, _TILE_IDS[ord(char)])
+        self.version = payload['version']
+        return True
 
     def serialize(self):
-        return json.dumps({
-            'dungeon_id': self.dungeon_id,
-            'tiles': self.tiles
-        })
+        if self._serialized is None:
+            chars = TILE_CHARS[self.tiles]
+            self._serialized = {
+                'dungeon_id': self.dungeon_id,
+                'session_id': self.session_id,
+                'version': self.version,
+                'width': self.width,
+                'height': self.height,
+                'tiles': [row.tobytes().decode('latin-1') for row in chars]
+            }
+        return self._serialized
+
+    def encode(self, codec) -> bytes:
+        """Return the full MAP message as a frame ready to send, encoded once per codec and version."""
+        if self._frames_version != self.version:
+            self._frames.clear()
+            self._frames_version = self.version
+        frame = self._frames.get(codec)
+        if frame is None:
+            frame = self._frames[codec] = net_utils.encode((constants.MAP, self.serialize()), codec)
+        return frame
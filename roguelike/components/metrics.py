@@ -0,0 +1,150 @@
+'''Metrics module with counters, histograms and gauges describing what the server is doing
+
+Recording is a lock and a few additions, cheap enough to leave on all the time. Anything more
+expensive, like summing up queues, is done by gauges only when the metrics are read. The metrics
+can be read over HTTP on localhost, see serve.
+'''
+
+import bisect
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram buckets for durations in seconds, from a microsecond up to about 16 seconds
+SECONDS = tuple(0.000001 * 2 ** i for i in range(25))
+
+
+def label(value, known) -> str:
+    """Return value if it's one of known, 'other' otherwise.
+
+    Labels taken from what clients send go through this, or any client could create metrics without end.
+    """
+    return value if value in known else 'other'
+
+
+class Counter:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def read(self):
+        return self.value
+
+
+class Histogram:
+    """Counts observations per bucket, so percentiles are estimated as the upper bound of a bucket."""
+
+    def __init__(self, bounds=SECONDS):
+        self.bounds = bounds
+        # The last bucket holds everything above the highest bound
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, p):
+        rank = p / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) else float('inf')
+        return 0
+
+    def read(self):
+        with self._lock:
+            return {
+                'count': self.count,
+                'mean': self.sum / self.count if self.count else 0,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99)
+            }
+
+
+class Gauge:
+    """A value read from a function whenever the metrics are read."""
+
+    def __init__(self, read):
+        self.read = read
+
+
+class Registry:
+    """All metrics by name, optionally split up by a label such as the event type.
+
+    Getting a metric creates it the first time, so hot paths can simply ask for it every time.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, label, *args):
+        metric = self._metrics.get((name, label))
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get((name, label))
+                if metric is None:
+                    metric = self._metrics[name, label] = cls(*args)
+        return metric
+
+    def counter(self, name, label=None) -> Counter:
+        return self._get(Counter, name, label)
+
+    def histogram(self, name, label=None, bounds=SECONDS) -> Histogram:
+        return self._get(Histogram, name, label, bounds)
+
+    def gauge(self, name, read, label=None):
+        with self._lock:
+            self._metrics[name, label] = Gauge(read)
+
+    def snapshot(self) -> dict:
+        """Read every metric, labelled ones grouped in a dictionary by label under their name."""
+        with self._lock:
+            metrics = sorted(self._metrics.items(), key=lambda item: (item[0][0], str(item[0][1])))
+        result = {}
+        for (name, label), metric in metrics:
+            value = metric.read()
+            if label is None:
+                result[name] = value
+            else:
+                result.setdefault(name, {})[label] = value
+        return result
+
+
+REGISTRY = Registry()
+
+
+def serve(registry=REGISTRY, port=7778, host='127.0.0.1') -> ThreadingHTTPServer:
+    """Serve the metrics as JSON on a background thread, only on localhost unless told otherwise."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = json.dumps(registry.snapshot(), indent=2, default=str).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    t = threading.Thread(target=server.serve_forever, name='metrics')
+    t.daemon = True
+    t.start()
+    return server
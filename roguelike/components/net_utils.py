@@ -1,81 +1,570 @@
 import socket
-import logging
 import threading
+import collections
 import json
 import struct
+import asyncio
+import constants
+from components import metrics
+from components.log import get_logger, Truncated
 
 
 # TODO: Make sure to error handle the json decoding
 # TODO: Make a parent class to handle common network functionality
 
 
-def get_logger():
-    logging.basicConfig(filename='server.log', level=logging.DEBUG,
-                        format='%(asctime)s %(levelname)s %(message)s',
-                        datefmt='%d/%m/%Y %I:%M:%S %p')
-    return logging.getLogger('tcpserver')
+logger = get_logger('net')
 
 
-logger = get_logger()
+HEADER = struct.Struct("<L")
 
 
-# define helper function for reading large data blobs
-def read_blob(sock, size):
-    logger.debug('entering readblob')
-    buf = ""
-    while len(buf) != size:
-        ret = sock.recv(size - len(buf)).decode('utf-8')
-        if not ret:
-            raise Exception("Socket closed")
-        buf += ret
-        logger.debug('this is going to shit most likely, %s' % ret)
-    logger.debug('exiting readblob, %s' % ret)
-    return buf
+class JsonCodec:
+    """Human readable encoding, handy when debugging the protocol."""
 
+    name = 'json'
 
-# define helper functions for reading header data
-def read_long(sock):
-    logger.debug('enterting readlong')
-    size = struct.calcsize("<L")
-    # TODO: Make sure to throw if empty packet comes through
-    data = sock.recv(size)
-    logger.debug(str(struct.unpack("<L", data)))
-    # returning first element because unpack returns a tuple
-    return struct.unpack("<L", data)[0]
+    def encode(self, message) -> bytes:
+        return json.dumps(message, separators=(',', ':')).encode('utf-8')
 
+    def decode(self, data):
+        return json.loads(str(data, 'utf-8'))
 
-def send(conn, message):
-    jdata = json.dumps(message).encode('utf-8')
-    conn.sendall(struct.pack("<L", len(jdata)))
-    conn.sendall(jdata)
 
+_SHORT = struct.Struct('<B')
+_LONG = struct.Struct('<L')
+_INT = struct.Struct('<i')
+_INT64 = struct.Struct('<q')
+_FLOAT = struct.Struct('<d')
+_MAP_SIZE = struct.Struct('<HH')
+_TILE_CHANGE = struct.Struct('<HHB')
 
-def get_socket_address(sock):
-    return str(sock.getpeername())
+
+def _pack_sized(out, short_tag, long_tag, size):
+    if size < 256:
+        out += short_tag
+        out += _SHORT.pack(size)
+    else:
+        out += long_tag
+        out += _LONG.pack(size)
+
+
+def _pack_value(out: bytearray, value):
+    if value is None:
+        out += b'n'
+    elif value is True:
+        out += b't'
+    elif value is False:
+        out += b'f'
+    elif isinstance(value, int):
+        if -2 ** 31 <= value < 2 ** 31:
+            out += b'i'
+            out += _INT.pack(value)
+        else:
+            out += b'q'
+            out += _INT64.pack(value)
+    elif isinstance(value, float):
+        out += b'd'
+        out += _FLOAT.pack(value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        _pack_sized(out, b's', b'S', len(data))
+        out += data
+    elif isinstance(value, (bytes, bytearray)):
+        _pack_sized(out, b'y', b'Y', len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        _pack_sized(out, b'l', b'L', len(value))
+        for item in value:
+            _pack_value(out, item)
+    elif isinstance(value, dict):
+        _pack_sized(out, b'm', b'M', len(value))
+        for key, item in value.items():
+            _pack_value(out, key)
+            _pack_value(out, item)
+    else:
+        raise TypeError('Cannot encode %s' % type(value).__name__)
+
+
+def _unpack_size(data, tag, offset):
+    if tag in b'sylm':
+        return _SHORT.unpack_from(data, offset)[0], offset + _SHORT.size
+    return _LONG.unpack_from(data, offset)[0], offset + _LONG.size
+
+
+def _unpack_value(data, offset):
+    tag = bytes(data[offset:offset + 1])
+    offset += 1
+    if tag == b'n':
+        return None, offset
+    if tag == b't':
+        return True, offset
+    if tag == b'f':
+        return False, offset
+    if tag == b'i':
+        return _INT.unpack_from(data, offset)[0], offset + _INT.size
+    if tag == b'q':
+        return _INT64.unpack_from(data, offset)[0], offset + _INT64.size
+    if tag == b'd':
+        return _FLOAT.unpack_from(data, offset)[0], offset + _FLOAT.size
+
+    size, offset = _unpack_size(data, tag, offset)
+    if tag in (b's', b'S'):
+        return str(data[offset:offset + size], 'utf-8'), offset + size
+    if tag in (b'y', b'Y'):
+        return bytes(data[offset:offset + size]), offset + size
+    if tag in (b'l', b'L'):
+        result = []
+        for _ in range(size):
+            item, offset = _unpack_value(data, offset)
+            result.append(item)
+        return result, offset
+    if tag in (b'm', b'M'):
+        result = {}
+        for _ in range(size):
+            key, offset = _unpack_value(data, offset)
+            result[key], offset = _unpack_value(data, offset)
+        return result, offset
+    raise ValueError('Unknown type tag %r' % tag)
+
+
+def _pack_map(out, payload):
+    # Tiles go out as one byte per tile instead of a list of strings
+    tiles = payload['tiles']
+    _pack_value(out, {key: value for key, value in payload.items() if key != 'tiles'})
+    width = len(tiles[0]) if tiles else 0
+    out += _MAP_SIZE.pack(width, len(tiles))
+    out += ''.join(tiles).encode('latin-1')
+
+
+def _unpack_map(data, offset):
+    payload, offset = _unpack_value(data, offset)
+    width, height = _MAP_SIZE.unpack_from(data, offset)
+    offset += _MAP_SIZE.size
+    tiles = str(data[offset:offset + width * height], 'latin-1')
+    payload['tiles'] = [tiles[row * width:(row + 1) * width] for row in range(height)]
+    return payload, offset + width * height
+
+
+def _pack_map_delta(out, payload):
+    tiles = payload['tiles']
+    _pack_value(out, {key: value for key, value in payload.items() if key != 'tiles'})
+    out += _LONG.pack(len(tiles))
+    for x, y, char in tiles:
+        out += _TILE_CHANGE.pack(x, y, ord(char))
+
+
+def _unpack_map_delta(data, offset):
+    payload, offset = _unpack_value(data, offset)
+    count, = _LONG.unpack_from(data, offset)
+    offset += _LONG.size
+    end = offset + count * _TILE_CHANGE.size
+    payload['tiles'] = [[x, y, chr(char)] for x, y, char in _TILE_CHANGE.iter_unpack(data[offset:end])]
+    return payload, end
+
+
+class BinaryCodec:
+    """Compact encoding, a type tag byte for the event followed by a struct packed payload.
+
+    Event types from constants.EVENT_TYPES are sent as their index, anything else as a string after
+    the UNKNOWN tag. Payloads of event types listed in payload_packers skip the generic encoding.
+    """
+
+    name = 'binary'
+    # 0xB1 is a UTF-8 continuation byte so a JSON document never starts with it, see decode_message
+    MAGIC = 0xB1
+    UNKNOWN = 0xFF
+
+    tags = {event_type: tag for tag, event_type in enumerate(constants.EVENT_TYPES)}
+    payload_packers = {
+        constants.MAP: (_pack_map, _unpack_map),
+        constants.MAP_DELTA: (_pack_map_delta, _unpack_map_delta)
+    }
+
+    def encode(self, message) -> bytes:
+        event_type, payload = message
+        out = bytearray((self.MAGIC,))
+        tag = self.tags.get(event_type)
+        if tag is None:
+            out.append(self.UNKNOWN)
+            _pack_value(out, event_type)
+        else:
+            out.append(tag)
+
+        packer = self.payload_packers.get(event_type)
+        if packer:
+            packer[0](out, payload)
+        else:
+            _pack_value(out, payload)
+        return bytes(out)
+
+    def decode(self, data):
+        tag = data[1]
+        offset = 2
+        if tag == self.UNKNOWN:
+            event_type, offset = _unpack_value(data, offset)
+        else:
+            event_type = constants.EVENT_TYPES[tag]
+
+        packer = self.payload_packers.get(event_type)
+        if packer:
+            payload, _ = packer[1](data, offset)
+        else:
+            payload, _ = _unpack_value(data, offset)
+        return [event_type, payload]
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+
+CODECS = {codec.name: codec for codec in (JSON, BINARY)}
+# Offered by clients at PLAYER_CONNECT, best first
+PREFERRED_CODECS = (BINARY.name, JSON.name)
+
+
+def negotiate_codec(offered) -> str:
+    """Pick the first codec offered by the other side that we support, JSON if there is none."""
+    for name in offered:
+        if name in CODECS:
+            return name
+    return JSON.name
+
+
+def decode_message(data):
+    """Decode a frame payload in whichever codec it was encoded with.
+
+    Frames are self describing, so a peer switching codecs after the handshake never has to be
+    in lock step with us.
+    """
+    if data and data[0] == BinaryCodec.MAGIC:
+        return BINARY.decode(data)
+    return JSON.decode(data)
+
+
+def recv_exactly(sock, view):
+    """Fill the whole memoryview from the socket, however many recv calls that takes."""
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError("Socket closed")
+        view = view[received:]
+
+
+def frame_size(header) -> int:
+    """Return the payload size in a frame header, refusing sizes no honest peer would send."""
+    size, = HEADER.unpack(header)
+    if size > constants.MAX_FRAME_SIZE:
+        raise ConnectionError('frame of %d bytes is over the limit of %d' % (size, constants.MAX_FRAME_SIZE))
+    return size
+
+
+class FrameReader:
+    """Reads length prefixed frames from a socket into one reusable buffer.
+
+    The buffer only ever grows, so once it fits the largest frame seen nothing is allocated per read.
+    """
+
+    def __init__(self, sock, size=4096):
+        self.socket = sock
+        self._header = bytearray(HEADER.size)
+        self._buffer = bytearray(size)
+
+    def read_frame(self) -> memoryview:
+        """Return a view on the payload of the next frame, only valid until the next read."""
+        recv_exactly(self.socket, memoryview(self._header))
+        size = frame_size(self._header)
+        if size > len(self._buffer):
+            self._buffer = bytearray(max(size, len(self._buffer) * 2))
+        view = memoryview(self._buffer)[:size]
+        recv_exactly(self.socket, view)
+        return view
+
+    def read_message(self):
+        # Decoding the complete frame at once keeps multi-byte characters split across recv calls intact
+        return decode_message(self.read_frame())
+
+
+def encode(message, codec=JSON) -> bytes:
+    """Encode a message into a complete frame, header included."""
+    data = codec.encode(message)
+    return HEADER.pack(len(data)) + data
+
+
+def frame_event_type(frame) -> str:
+    """Return the event type of an encoded frame without decoding the payload."""
+    if frame[HEADER.size] == BinaryCodec.MAGIC:
+        tag = frame[HEADER.size + 1]
+        return constants.EVENT_TYPES[tag] if tag < len(constants.EVENT_TYPES) else 'unknown'
+    # JSON frames start with ["EVENT_TYPE",
+    start = HEADER.size + 2
+    return bytes(frame[start:frame.find(b'"', start)]).decode()
+
+
+def count_sent(frames) -> int:
+    """Record frames written to a connection in the metrics, returns the number of bytes."""
+    size = 0
+    for frame in frames:
+        size += len(frame)
+        metrics.REGISTRY.counter('messages_out', frame_event_type(frame)).inc()
+    metrics.REGISTRY.counter('bytes_out').inc(size)
+    return size
+
+
+def count_received(size):
+    metrics.REGISTRY.counter('bytes_in').inc(size)
+    return size
+
+
+def send(conn, message, codec=JSON):
+    conn.sendall(encode(message, codec))
+
+
+def broadcast(recipients, message, exclude=()):
+    """Send one message to many recipients, encoding it only once for each codec in use.
+
+    Recipients need a codec attribute and a send_frame method, all of them get the same frame
+    object. Anyone in exclude, the sender for instance, is skipped.
+    """
+    frames = {}
+    for recipient in recipients:
+        if recipient in exclude:
+            continue
+        frame = frames.get(recipient.codec)
+        if frame is None:
+            frame = frames[recipient.codec] = encode(message, recipient.codec)
+        recipient.send_frame(frame)
+
+
+def send_frames(conn, frames):
+    """Write a batch of frames with as few system calls as possible."""
+    if not hasattr(conn, 'sendmsg'):
+        # Windows has no vectored writes, a single joined buffer is the next best thing
+        conn.sendall(b''.join(frames))
+        return
+
+    views = [memoryview(frame) for frame in frames]
+    while views:
+        sent = conn.sendmsg(views)
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+# What to do when a connection's outbound queue is full
+DROP = 'drop'
+DISCONNECT = 'disconnect'
+BLOCK = 'block'
+POLICIES = (DROP, DISCONNECT, BLOCK)
+
+
+class OutboundQueue:
+    """Bounded queue of encoded frames waiting to be written to a single connection.
+
+    When a slow client lets the queue fill up, the policy decides between dropping the new frame,
+    closing the queue (which disconnects the client) or blocking the sender until there is room.
+    Senders never write to the socket themselves, so one slow client can't stall the others.
+    """
+
+    def __init__(self, size=256, policy=DROP):
+        if policy not in POLICIES:
+            raise ValueError('Unknown slow consumer policy %s' % policy)
+        self.size = size
+        self.policy = policy
+        self.closed = False
+        self.dropped = 0
+        # Called after every change, lets writers that can't wait on the condition get woken up
+        self.notify = None
+        # Called once when the queue closes, lets the owner unblock a writer stuck on a full socket
+        self.on_close = None
+        self._frames = collections.deque()
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame) -> bool:
+        with self._condition:
+            if self.policy == BLOCK:
+                self._condition.wait_for(lambda: len(self._frames) < self.size or self.closed)
+            overflow = len(self._frames) >= self.size
+            if overflow and self.policy == DROP:
+                self.dropped += 1
+            added = not (self.closed or overflow)
+            if added:
+                self._frames.append(frame)
+                self._condition.notify_all()
+
+        if overflow and self.policy == DISCONNECT:
+            self.close()
+        elif added and self.notify:
+            self.notify()
+        return added
+
+    def take(self, limit=64, block=True) -> list:
+        """Remove and return up to limit frames, waiting for the first one if block is set.
+
+        Returns an empty list once the queue is closed.
+        """
+        with self._condition:
+            if block:
+                self._condition.wait_for(lambda: self._frames or self.closed)
+            frames = []
+            while self._frames and len(frames) < limit:
+                frames.append(self._frames.popleft())
+            self._condition.notify_all()
+            return frames
+
+    def close(self):
+        with self._condition:
+            if self.closed:
+                return
+            self.closed = True
+            self._frames.clear()
+            self._condition.notify_all()
+        if self.notify:
+            self.notify()
+        if self.on_close:
+            self.on_close()
 
 
 class MessageListener:
     # TODO make public
     socket = None
 
-    def __init__(self, socket, listener):
+    def __init__(self, socket, listener, queue: OutboundQueue = None):
         self.listener = listener
         self.socket = socket
+        # Codec used for outgoing messages, switched once the PLAYER_CONNECT handshake is done
+        self.codec = JSON
+        # Without a queue messages are written directly on the sending thread
+        self.queue = queue
+        if queue is not None:
+            queue.on_close = self._shutdown
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def send(self, message):
+        self.send_frame(encode(message, self.codec))
+
+    def send_frame(self, frame):
+        if self.queue is not None:
+            self.queue.put(frame)
+        else:
+            self.socket.sendall(frame)
+            self.bytes_out += count_sent((frame,))
 
     def listen(self):
+        reader = FrameReader(self.socket)
         while True:
             try:
-                logger.debug('(client): message incoming')
-                datasize = read_long(self.socket)
-                data = read_blob(self.socket, datasize)
-                jdata = json.loads(data)
-                logger.debug('[client]: %s' % str(jdata))
+                frame = reader.read_frame()
+                self.bytes_in += count_received(HEADER.size + len(frame))
+                jdata = decode_message(frame)
+                logger.debug('received %s', Truncated(jdata))
 
                 self.listener.on_message_received(self.socket, jdata)
+            except OSError as e:
+                logger.debug('connection closed: %s', e)
+                break
             # Maybe actually handle the exeption, we actually just want to break the loop
-            except Exception as e:
-                print(e)
+            except Exception:
+                logger.exception('error handling a message, closing the connection')
                 break
 
+        if self.queue is not None:
+            self.queue.close()
         self.listener.on_disconnect(self)
         self.socket.close()
+
+    def write(self):
+        """Drain the outbound queue into the socket until either side closes."""
+        while True:
+            frames = self.queue.take()
+            if not frames:
+                break
+            try:
+                send_frames(self.socket, frames)
+            except OSError:
+                self.queue.close()
+                break
+            self.bytes_out += count_sent(frames)
+
+    def _shutdown(self):
+        # Wakes up both the listening and the writing thread, whichever side gave up on the connection
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class AsyncMessageListener:
+    """Asyncio counterpart of MessageListener.
+
+    Reads messages from a stream reader and calls back the listener on the event loop thread,
+    passing the transport socket in the same place MessageListener passes the raw socket.
+    Outgoing frames always go through the queue, which the write coroutine drains.
+    """
+
+    def __init__(self, reader, writer, listener, queue: OutboundQueue):
+        self.listener = listener
+        self.reader = reader
+        self.writer = writer
+        self.socket = writer.get_extra_info('socket')
+        self.codec = JSON
+        self.queue = queue
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def send(self, message):
+        self.send_frame(encode(message, self.codec))
+
+    def send_frame(self, frame):
+        self.queue.put(frame)
+
+    async def listen(self):
+        while True:
+            try:
+                header = await self.reader.readexactly(HEADER.size)
+                data = await self.reader.readexactly(frame_size(header))
+                self.bytes_in += count_received(HEADER.size + len(data))
+                jdata = decode_message(data)
+                logger.debug('received %s', Truncated(jdata))
+
+                self.listener.on_message_received(self.socket, jdata)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            except Exception:
+                logger.exception('error handling a message, closing the connection')
+                break
+
+        self.queue.close()
+        self.listener.on_disconnect(self)
+        self.writer.close()
+
+    async def write(self):
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        # Frames may be queued from other threads, so the event is always set from the loop itself
+        self.queue.notify = lambda: loop.call_soon_threadsafe(wakeup.set)
+        self.queue.on_close = lambda: loop.call_soon_threadsafe(self.writer.transport.abort)
+
+        while True:
+            frames = self.queue.take(block=False)
+            if not frames:
+                if self.queue.closed:
+                    break
+                wakeup.clear()
+                await wakeup.wait()
+                continue
+            try:
+                # Python 3.12+ turns this into a single vectored write
+                self.writer.writelines(frames)
+                self.bytes_out += count_sent(frames)
+                await self.writer.drain()
+            except ConnectionError:
+                self.queue.close()
+
+        self.writer.close()
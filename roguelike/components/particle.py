@@ -1,69 +1,117 @@
 import tcod.console
-import tcod
-from typing import List
-import random
+import numpy as np
 
+# Defaults for the keys a pconf dictionary can set
+PARTICLE_DEFAULTS = {
+    'vx': (1, 1),
+    'vy': (-1, -1),
+    'ax': 0,
+    'ay': 0,
+    'col': (50, 50, 50),
+    'fade': 0,
+    'length': 1,
+    'height': 1,
+    'life': 50
+}
 
-class Emitter:
+# Columns of the particle state array
+X, Y, VX, VY, FADE, LIFE = range(6)
+COL = slice(6, 9)
 
-    def __init__(self, console, pconf: dict, x: int, y: int, w: int, h: int, rate: int = 1):
-        self.x = x
-        self.y = y
-        self.w = w
-        self.h = h
+_rng = np.random.default_rng()
 
-        self.rate = rate
-        self.pconf = pconf
 
-        self.console: tcod.console.Console = console
-        self.particles: List[Particle] = []
+def _bg_yx(console: tcod.console.Console, order: str) -> np.ndarray:
+    """Return the console background indexed [y, x], given the order the console was created with."""
+    if order == 'F':
+        return console.bg.transpose(1, 0, 2)
+    return console.bg
 
-    def create_particle(self):
-        for i in range(self.rate):
-            self.particles.append(
-                Particle(self.x + random.randint(0, self.w - 1),
-                         self.y + random.randint(0, self.h - 1), **self.pconf))
-
-    def draw(self):
-        for p in self.particles:
-            p.simulate()
-            if p.life <= 0 or p._fadec >= 1:
-                self.particles.remove(p)
-            p.draw(self.console)
 
+class Emitter:
+    """Spawns particles in a rectangle and draws them onto a console.
 
-class Particle:
+    All particles of an emitter share its pconf, so their state lives in a single (n, 9) array with a
+    row per particle. Simulating, culling and drawing are a handful of numpy operations no matter how
+    many particles are alive, drawing is one additive write into the console background.
+    """
 
-    def __init__(self, x, y, vx: tuple = (1, 1), vy: tuple = (-1, -1), ax: float = 0, ay: float = 0,
-                 col: tuple = (50, 50, 50),
-                 fade: float = 0, length: int = 1, height: int = 1, life: int = 50):
+    def __init__(self, console, pconf: dict, x: int, y: int, w: int, h: int, rate: int = 1, order: str = 'F'):
         self.x = x
         self.y = y
+        self.w = w
+        self.h = h
 
-        self.length = length
-        self.height = height
-
-        self.col = col
-        self.fade = fade
-        self._fadec = 0
+        self.rate = rate
+        self.pconf = pconf
+        conf = dict(PARTICLE_DEFAULTS, **pconf)
+        self.vx = conf['vx']
+        self.vy = conf['vy']
+        self.ax = conf['ax']
+        self.ay = conf['ay']
+        self.col = conf['col']
+        self.fade = conf['fade']
+        self.length = conf['length']
+        self.height = conf['height']
+        self.life = conf['life']
 
-        self.ax = ax
-        self.ay = ay
+        self.console: tcod.console.Console = console
+        # The order the console was created with, the game creates all of them in order F
+        self.order = order
+        self.particles = np.empty((0, 9))
 
-        self.vx = random.randint(*vx) / 100
-        self.vy = random.randint(*vy) / 20
+    def __len__(self):
+        return len(self.particles)
 
-        self.life = life
+    def create_particle(self):
+        new = np.empty((self.rate, 9))
+        new[:, X] = self.x + _rng.integers(0, self.w, self.rate)
+        new[:, Y] = self.y + _rng.integers(0, self.h, self.rate)
+        new[:, VX] = _rng.integers(self.vx[0], self.vx[1] + 1, self.rate) / 100
+        new[:, VY] = _rng.integers(self.vy[0], self.vy[1] + 1, self.rate) / 20
+        new[:, FADE] = 0
+        new[:, LIFE] = self.life
+        new[:, COL] = self.col
+        self.particles = np.concatenate((self.particles, new))
 
     def simulate(self):
-        self.x += self.vx
-        self.y += self.vy
-        self._fadec += self.fade
-        self.col = tcod.color_lerp(self.col, (0, 0, 0), self._fadec)
-        self.vx += self.ax
-        self.vy += self.ay
-        self.life -= 1
-
-    def draw(self, console: tcod.console.Console):
-        for i in range(self.height):
-            console.print(int(self.x), int(self.y - i), ' ' * self.length, bg=self.col, bg_blend=tcod.BKGND_ADD)
+        p = self.particles
+        p[:, X] += p[:, VX]
+        p[:, Y] += p[:, VY]
+        p[:, FADE] += self.fade
+        # Same as tcod.color_lerp towards black, which works in single precision and truncates every step
+        col = p[:, COL].astype(np.float32)
+        p[:, COL] = np.floor(col - col * p[:, FADE, np.newaxis].astype(np.float32))
+        p[:, VX] += self.ax
+        p[:, VY] += self.ay
+        p[:, LIFE] -= 1
+        self.particles = p[(p[:, LIFE] > 0) & (p[:, FADE] < 1)]
+
+    def draw(self):
+        self.simulate()
+        if len(self.particles):
+            bg = _bg_yx(self.console, self.order)
+            bg[...] = np.minimum(bg + self._composite(bg.shape[0], bg.shape[1]), 255)
+
+    def _composite(self, height, width) -> np.ndarray:
+        """Sum the colours of all particles covering each cell of a (height, width) console.
+
+        A particle anchored at (x, y) covers length cells to the right and height cells upwards. The
+        colours are first summed per anchor, after which a box sum over the anchors gives the total
+        for every cell, so the cost doesn't depend on the size of the particles.
+        """
+        length, rows = self.length, self.height
+        xs = self.particles[:, X].astype(int)
+        ys = self.particles[:, Y].astype(int)
+        # Anchors just outside the console can still have part of their footprint on it
+        grid_h, grid_w = height + rows - 1, width + length - 1
+        on_grid = (ys >= 0) & (ys < grid_h) & (xs > -length) & (xs < width)
+        index = ys[on_grid] * grid_w + xs[on_grid] + length - 1
+
+        sums = np.zeros((grid_h + 1, grid_w + 1, 3))
+        for channel in range(3):
+            anchors = np.bincount(index, self.particles[on_grid, 6 + channel], grid_h * grid_w)
+            sums[1:, 1:, channel] = anchors.reshape(grid_h, grid_w).cumsum(0).cumsum(1)
+
+        return (sums[rows:rows + height, length:length + width] - sums[:height, length:length + width]
+                - sums[rows:rows + height, :width] + sums[:height, :width])
@@ -0,0 +1,138 @@
+'''Pathfinding module with distance fields for monsters to move along
+
+A distance field holds for every tile how many steps it is away from the nearest goal. Once it's
+computed any number of monsters can find their next step by looking at the tiles around them,
+instead of each searching its own path.
+'''
+
+from collections import deque
+
+import numpy as np
+
+# Neighbours in the order they're tried when stepping, so equally good steps always go the same way
+NEIGHBOURS = ((0, -1), (1, 0), (0, 1), (-1, 0), (1, -1), (1, 1), (-1, 1), (-1, -1))
+
+# How much further away fleeing monsters would like to be than they are from the goal
+FLEE_FACTOR = -1.2
+
+
+def _relax(field: np.ndarray, walkable: np.ndarray) -> np.ndarray:
+    """Lower every walkable tile to one more than its lowest neighbour, wherever that gets it lower.
+
+    A breadth first search from every tile with a finite value at once, visiting every tile once.
+    Tiles are settled in order of their value: the starting tiles in sorted order, merged with the
+    tiles reached from them in the order they were reached, which is sorted too as every step costs one.
+    """
+    height, width = field.shape
+    # A border of walls around the map, so neighbours never need a bounds check
+    padded_width = width + 2
+    walls = np.ones((height + 2, padded_width), dtype=bool)
+    walls[1:-1, 1:-1] = ~walkable
+    start = np.full((height + 2, padded_width), np.inf)
+    start[1:-1, 1:-1] = np.where(walkable, field, np.inf)
+    start = start.ravel()
+
+    sources = np.flatnonzero(np.isfinite(start))
+    sources = sources[np.argsort(start[sources], kind='stable')].tolist()
+    values = start.tolist()
+    walls = walls.ravel().tolist()
+    settled = bytearray(len(values))
+    offsets = [dy * padded_width + dx for dx, dy in NEIGHBOURS]
+
+    reached = deque()
+    next_source = 0
+    while next_source < len(sources) or reached:
+        if reached and (next_source == len(sources) or reached[0][0] <= start[sources[next_source]]):
+            value, index = reached.popleft()
+        else:
+            index = sources[next_source]
+            value = start[index]
+            next_source += 1
+        if settled[index]:
+            continue
+        settled[index] = 1
+        value += 1
+        for offset in offsets:
+            neighbour = index + offset
+            if not walls[neighbour] and value < values[neighbour]:
+                values[neighbour] = value
+                reached.append((value, neighbour))
+
+    return np.array(values).reshape(height + 2, padded_width)[1:-1, 1:-1]
+
+
+def distance_field(walkable: np.ndarray, goals) -> np.ndarray:
+    """Return the steps from every tile to the nearest of the (x, y) goals, inf where there's no way there."""
+    field = np.full(walkable.shape, np.inf)
+    for x, y in goals:
+        field[y, x] = 0
+    return _relax(field, walkable)
+
+
+def flee_field(walkable: np.ndarray, goals) -> np.ndarray:
+    """Return a field leading away from the goals.
+
+    Simply walking up a distance field gets monsters stuck in dead ends, so the distances are
+    turned around and scaled, and relaxed again. Tiles far from the goals become the new low
+    points, but a monster will rather run past the goals than into a corner right next to them.
+    """
+    return _flee(walkable, distance_field(walkable, goals))
+
+
+def _flee(walkable, distances):
+    field = distances * FLEE_FACTOR
+    # Tiles that can't reach a goal get -inf from the scaling, nothing to flee from there
+    field[np.isneginf(field)] = np.inf
+    return _relax(field, walkable)
+
+
+def step(field: np.ndarray, x, y):
+    """Return the neighbouring (x, y) lowest on the field, or None when no neighbour is lower than (x, y)."""
+    height, width = field.shape
+    best, lowest = None, field[y, x]
+    for dx, dy in NEIGHBOURS:
+        nx, ny = x + dx, y + dy
+        if 0 <= nx < width and 0 <= ny < height and field[ny, nx] < lowest:
+            best, lowest = (nx, ny), field[ny, nx]
+    return best
+
+
+class Pathfinder:
+    """Distance fields on a map, cached until the map changes.
+
+    The distances to every goal are cached separately, and the field for a set of goals is the
+    lowest of them, so when one goal moves only its own distances are built again. Fields are
+    shared between everyone asking for the same goals, so don't change them.
+    """
+
+    def __init__(self, game_map, cache_size=64):
+        self.map = game_map
+        self.cache_size = cache_size
+        self._cache = {}
+        self._version = game_map.version
+
+    def toward(self, goals) -> np.ndarray:
+        return self._cached(('toward', frozenset(goals)), self._distances)
+
+    def away_from(self, goals) -> np.ndarray:
+        return self._cached(('away', frozenset(goals)), lambda goals: _flee(self.map.walkable, self._distances(goals)))
+
+    def _distances(self, goals) -> np.ndarray:
+        fields = [self._cached(('goal', goal), lambda goal: distance_field(self.map.walkable, [goal]))
+                  for goal in goals]
+        if not fields:
+            return distance_field(self.map.walkable, ())
+        return np.minimum.reduce(fields)
+
+    def _cached(self, key, build) -> np.ndarray:
+        if self._version != self.map.version:
+            self._cache.clear()
+            self._version = self.map.version
+
+        field = self._cache.get(key)
+        if field is None:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            field = self._cache[key] = build(key[1])
+            field.flags.writeable = False
+        return field
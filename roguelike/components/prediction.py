@@ -0,0 +1,142 @@
+'''Prediction module hiding the round trip to the server from the player
+
+The player's own moves are applied to a local copy of the game state as soon as they're made, and
+sent with a sequence number. Once the server reports which of them it applied, the local state is
+reset to what the server says and the moves it hasn't seen yet are applied again on top.
+
+Other players only move when a snapshot says so, once per tick, so they're shown gliding from
+where they were to where they are over the length of a tick instead of jumping.
+'''
+
+import collections
+import time
+
+import numpy as np
+
+import constants
+from components import game
+
+
+class Track:
+    """Where another player is drawn, moving from the last known position to the newest one."""
+
+    def __init__(self, x, y, now, duration):
+        self.duration = duration
+        self.start = (x, y)
+        self.end = (x, y)
+        self.started = now
+
+    def move(self, x, y, now):
+        self.start = self.position(now)
+        self.end = (x, y)
+        self.started = now
+
+    def progress(self, now):
+        return min(1.0, (now - self.started) / self.duration)
+
+    def position(self, now):
+        t = self.progress(now)
+        return (self.start[0] + (self.end[0] - self.start[0]) * t,
+                self.start[1] + (self.end[1] - self.start[1]) * t)
+
+
+class Prediction:
+    """Local game state of a session as the client expects it to be.
+
+    predict is called from the input handling, reconcile and observe with the PLAYER_RESOLVE and
+    SNAPSHOT payloads handed over by Client.process_events, all on the main thread.
+    """
+
+    def __init__(self, player_id, game_map, tick_interval=1 / constants.TICK_RATE):
+        # The id the server gave us, what results about our own character are reported by
+        self.player_id = player_id
+        self.state = game.GameState(game_map)
+        self.tick_interval = tick_interval
+        # Our own character, unknown until the server tells us where we spawned
+        self.player = None
+        self.seq = 0
+        self.pending = collections.deque()
+        self.others = {}
+        self.tracks = {}
+
+    def position(self):
+        """Return where our own character is predicted to be, None before it spawned."""
+        if self.player is None:
+            return None
+        return self.player.entity.x, self.player.entity.y
+
+    def predict(self, action: game.Action) -> int:
+        """Apply one of our own actions right away, returns the sequence number to send it with."""
+        self.seq += 1
+        self.pending.append((self.seq, action))
+        self._apply(action)
+        return self.seq
+
+    def reconcile(self, payload):
+        """Take over the results of a server tick and replay whatever the server hasn't applied yet."""
+        own = None
+        for result in payload['results']:
+            if result['player'] == self.player_id:
+                own = result
+
+        ack = payload.get('acks', {}).get(self.player_id)
+        if ack is not None:
+            while self.pending and self.pending[0][0] <= ack:
+                self.pending.popleft()
+
+        if own is not None:
+            if self.player is None:
+                self.player = game.Player(None, (255, 255, 255), self.player_id)
+                self.player.entity.x, self.player.entity.y = own['x'], own['y']
+                self.state.add_player(self.player, spawn=False)
+            else:
+                self.state.move_entity(self.player.entity, own['x'], own['y'])
+            for _, action in self.pending:
+                self._apply(action)
+
+    def observe(self, seen: dict, now=None):
+        """Move the other characters to where the latest snapshot, by player id, has them.
+
+        The ones missing from it went out of view and are forgotten.
+        """
+        now = time.monotonic() if now is None else now
+        for player_id in list(self.others):
+            if player_id not in seen:
+                self._forget(player_id)
+        for player_id, fields in seen.items():
+            if player_id != self.player_id:
+                self._update_other(player_id, fields['x'], fields['y'], now)
+
+    def entities(self, now=None) -> list:
+        """Return (id, x, y) of every character to draw, other players at their interpolated position."""
+        now = time.monotonic() if now is None else now
+        drawn = [(player_id, *track.position(now)) for player_id, track in self.tracks.items()]
+        if self.player is not None:
+            drawn.append((self.player_id, self.player.entity.x, self.player.entity.y))
+        return drawn
+
+    def animating(self, now=None) -> bool:
+        now = time.monotonic() if now is None else now
+        return any(track.progress(now) < 1 for track in self.tracks.values())
+
+    def _apply(self, action):
+        if self.player is None or action.type != 'MOVE' or not game.is_step(self.player.entity, action.value):
+            return
+        target = np.array([action.value], dtype=int)
+        if self.state.validate_moves([self.player], target)[0]:
+            self.state.move_entity(self.player.entity, *action.value)
+
+    def _update_other(self, player_id, x, y, now):
+        other = self.others.get(player_id)
+        if other is None:
+            other = self.others[player_id] = game.Player(None, (255, 255, 255), player_id)
+            other.entity.x, other.entity.y = x, y
+            self.state.add_player(other, spawn=False)
+            self.tracks[player_id] = Track(x, y, now, self.tick_interval)
+        elif (other.entity.x, other.entity.y) != (x, y):
+            self.state.move_entity(other.entity, x, y)
+            self.tracks[player_id].move(x, y, now)
+
+    def _forget(self, player_id):
+        self.state.remove_player(self.others.pop(player_id))
+        del self.tracks[player_id]
@@ -0,0 +1,129 @@
+"""Render module with the building blocks of the client's screen
+
+The screen is made up of layers which are each rendered into an off-screen console, and only
+rendered again when something on them changed. Every frame the layers are just blitted onto the
+root console, which is a single call per layer instead of one per cell.
+"""
+
+import numpy as np
+from tcod.console import Console
+
+BRICK_THEME = {
+    'brick': (90, 90, 98),
+    'mortar': (50, 50, 58),
+    'brick_width': 8,
+    'brick_height': 4
+}
+
+
+def brick_mask(width, height, brick_width=8, brick_height=4) -> np.ndarray:
+    """Return a (width, height) array that is True where the mortar between the bricks goes."""
+    x, y = np.indices((width, height))
+    mortar = y % (brick_height + 1) == 0
+    # Every other row of bricks is shifted by half a brick
+    shifted = y % (brick_height * 2 + 2) - 2 >= brick_height / 2 + 1
+    mortar |= ~shifted & (x % (brick_width + 1) == 0)
+    mortar |= shifted & (x % (brick_width + 1) == brick_width / 2)
+    return mortar
+
+
+class Background:
+    """Brick wall backdrop with a frame and title around the screen.
+
+    Rendered once into an off-screen console, which is only rendered again when the size of the
+    console it's drawn on or the theme changes.
+    """
+
+    def __init__(self, title='', theme=BRICK_THEME):
+        self.title = title
+        self.theme = theme
+        self._console = None
+
+    def set_theme(self, theme):
+        self.theme = theme
+        self._console = None
+
+    def draw(self, console: Console):
+        """Replace everything on the console with the background."""
+        cached = self._console
+        if cached is None or (cached.width, cached.height) != (console.width, console.height):
+            self._console = cached = self._render(console.width, console.height)
+        cached.blit(console)
+
+    def _render(self, width, height) -> Console:
+        theme = self.theme
+        console = Console(width, height, order='F')
+        console.clear()
+        console.bg[...] = theme['brick']
+        console.bg[brick_mask(width, height, theme['brick_width'], theme['brick_height'])] = theme['mortar']
+        console.draw_frame(0, 0, width, height, clear=False, title=self.title)
+        return console
+
+
+# Cells of a layer with this background show the layers below them
+TRANSPARENT = (255, 0, 255)
+
+
+class Layer:
+    """Off-screen console holding one part of the screen.
+
+    render is called with the layer's console only while the layer is dirty, every other frame the
+    console is blitted as it is. Anything changing what a layer shows should call mark_dirty.
+    Layers that aren't opaque start out transparent every time they're rendered.
+    """
+
+    def __init__(self, name, width, height, render, opaque=False):
+        self.name = name
+        self.render = render
+        self.opaque = opaque
+        self.console = Console(width, height, order='F')
+        self.visible = True
+        self.dirty = True
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    def draw(self, root_console: Console):
+        if self.dirty:
+            # Cleared first, so changes made while rendering mark the layer dirty again
+            self.dirty = False
+            if not self.opaque:
+                self.console.clear(bg=TRANSPARENT)
+            self.render(self.console)
+
+        if self.opaque:
+            self.console.blit(root_console)
+        else:
+            self.console.blit(root_console, key_color=TRANSPARENT)
+
+
+class Compositor:
+    """Named layers drawn bottom to top onto the root console, in the order they were added."""
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.layers = []
+        self._layers = {}
+
+    def __getitem__(self, name) -> Layer:
+        return self._layers[name]
+
+    def add_layer(self, name, render, opaque=False) -> Layer:
+        layer = Layer(name, self.width, self.height, render, opaque)
+        self.layers.append(layer)
+        self._layers[name] = layer
+        return layer
+
+    def mark_dirty(self, name=None):
+        """Mark a single layer dirty, or all of them without a name."""
+        for layer in ([self._layers[name]] if name else self.layers):
+            layer.mark_dirty()
+
+    def set_visible(self, name, visible):
+        self._layers[name].visible = visible
+
+    def draw(self, root_console: Console):
+        for layer in self.layers:
+            if layer.visible:
+                layer.draw(root_console)
@@ -1,12 +1,25 @@
+import argparse
+import asyncio
+import itertools
 import socket
 import threading
+import time
 import constants
-from components.net_utils import send, MessageListener, get_socket_address
+from components import log, metrics
+from components.net_utils import broadcast, MessageListener, AsyncMessageListener, OutboundQueue, CODECS, \
+    negotiate_codec, POLICIES, DROP, BLOCK
 from managers.sessions import *
+from managers.shards import ShardedSessionManager
 
 """Server module containing server logic
 """
 
+logger = log.get_logger('server')
+
+HOST = '0.0.0.0'
+PORT = 7777
+METRICS_PORT = 7778
+
 
 def start_thread(func):
     t = threading.Thread(target=func)
@@ -16,80 +29,194 @@ def start_thread(func):
 
 class Player:
     name = "???"
+    _ids = itertools.count(1)
 
     def __init__(self, listener):
         self.listener = listener
         self.is_ready = False
+        # Names are picked by the players and not unique, sessions tell players apart by this
+        self.id = str(next(self._ids))
 
     def set_name(self, name):
         self.name = name
 
+    def set_codec(self, name):
+        self.listener.codec = CODECS[name]
+
+    @property
+    def codec(self):
+        return self.listener.codec
+
     def send(self, msg):
-        send(self.listener.socket, msg)
+        self.listener.send(msg)
 
+    def send_frame(self, frame):
+        self.listener.send_frame(frame)
 
-class Server:
-    players = []
 
-    def __init__(self):
-        print('start server')
-        self.session_manager = SessionManager()
+class Server:
+    """Server handling every connection on its own thread."""
+
+    def __init__(self, host=HOST, port=PORT, queue_size=constants.OUTBOUND_QUEUE_SIZE, policy=DROP, shards=0):
+        logger.info('start server')
+        # Without shards every session runs in this process
+        self.session_manager = ShardedSessionManager(shards) if shards else SessionManager()
+        # Connected players by the socket their messages come in on
+        self.players = {}
+        self.host = host
+        self.port = port
+        self.server_sock = None
+        self.queue_size = queue_size
+        self.policy = policy
+
+        registry = metrics.REGISTRY
+        registry.gauge('players', lambda: len(self.players))
+        registry.gauge('sessions', lambda: len(self.session_manager.sessions))
+        registry.gauge('outbound_queue_depth', self._queue_depths)
+        registry.gauge('connections', self._connection_stats)
+
+    def start(self):
+        """Serve on a background thread and return immediately."""
+        start_thread(self.serve_forever)
+
+    def serve_forever(self):
         self.server_sock = s = socket.socket()  # Create a socket object
-        host = '0.0.0.0'
-        port = 7777  # Reserve a port for your service.
-
-        s.bind((host, port))  # Bind to the port
+        s.bind((self.host, self.port))  # Bind to the port
         s.listen(5)
-
-        start_thread(self.listen_for_connections())
+        self.listen_for_connections()
 
     def listen_for_connections(self):
-        print('start listening for connections')
+        logger.info('start listening for connections on %s:%d', self.host, self.port)
         while True:
             sock, addr = self.server_sock.accept()
             self.on_connect(sock)
         self.server_sock.close()
 
     def on_connect(self, sock):
-        listener = MessageListener(sock, self)
-        self.players.append(Player(listener))
+        listener = MessageListener(sock, self, OutboundQueue(self.queue_size, self.policy))
+        self.players[listener.socket] = Player(listener)
         start_thread(listener.listen)
+        start_thread(listener.write)
 
     def on_disconnect(self, listener):
-        sessions = self.session_manager.get_sessions_for_player(listener.socket)
-        if sessions is not None:
-            for s in sessions:
-                s.leave(listener.socket)
-
-        player = self.get_player_for_socket(listener.socket)
-        self.players.remove(player)
+        player = self.players.pop(listener.socket, None)
+        if player is None:
+            return
+        self.session_manager.remove_player(player)
         self.send_to_all(player,  "disconnected")
 
     def on_message_received(self, sock, event):
+        start = time.perf_counter()
+        self._handle_message(sock, event)
+        event_type = metrics.label(event[0], constants.EVENT_TYPES)
+        metrics.REGISTRY.counter('messages_in', event_type).inc()
+        metrics.REGISTRY.histogram('handler_seconds', event_type).observe(time.perf_counter() - start)
+
+    def _handle_message(self, sock, event):
         player = self.get_player_for_socket(sock)
         if player is None:
-            print("player not found")
+            logger.warning('message from unknown socket %s', sock)
+            return
 
         if event[0] == constants.GLOBAL_CHAT:
             self.send_to_all(player, event[1]['message'])
         elif event[0] == constants.PLAYER_CONNECT:
             player.set_name(event[1]['name'])
+            # The answer still goes out in JSON, everything after it in the negotiated codec
+            codec = negotiate_codec(event[1].get('codecs', ()))
+            player.send((constants.PLAYER_CONNECT, {'codec': codec, 'id': player.id}))
+            player.set_codec(codec)
             self.send_to_all(player, "connected")
         elif event[0] == constants.LOBBIES:
             self.session_manager.on_lobby_event(player, event[1])
+        elif event[0] == constants.MAP_RESYNC:
+            self.session_manager.on_map_resync(player, event[1])
         elif event[0] == constants.PLAYER_INTENT:
             self.session_manager.on_player_intent(player, event[1])
+        elif event[0] == constants.SNAPSHOT_ACK:
+            self.session_manager.on_snapshot_ack(player, event[1])
 
     def get_player_for_socket(self, sock) -> Player:
-        for p in self.players:
-            if p.listener.socket == sock:
-                return p
-        return None
-
-    def send_to_all(self, player, message):
-        for p in self.players:
-            send(p.listener.socket, (constants.GLOBAL_CHAT, {'message': message, 'player': player.name}))
+        return self.players.get(sock)
+
+    def send_to_all(self, player, message, exclude=()):
+        # Copied because players connect and disconnect on other threads while we're sending
+        message = (constants.GLOBAL_CHAT, {'message': message, 'player': player.name})
+        broadcast(list(self.players.values()), message, exclude)
+
+    def _queue_depths(self):
+        depths = [len(p.listener.queue) for p in list(self.players.values()) if p.listener.queue is not None]
+        return {
+            'total': sum(depths),
+            'max': max(depths, default=0),
+            'dropped': sum(p.listener.queue.dropped for p in list(self.players.values())
+                           if p.listener.queue is not None)
+        }
+
+    def _connection_stats(self):
+        return [{'player': p.name, 'bytes_in': p.listener.bytes_in, 'bytes_out': p.listener.bytes_out}
+                for p in list(self.players.values())]
+
+    def serve_metrics(self, port=METRICS_PORT):
+        """Make the metrics readable as JSON over HTTP on localhost."""
+        return metrics.serve(metrics.REGISTRY, port)
+
+
+class AsyncServer(Server):
+    """Server handling every connection as a coroutine on a single asyncio event loop.
+
+    Speaks the same protocol and calls the same handlers as Server, so the number of OS threads
+    stays fixed no matter how many clients are connected. All handlers run on the event loop thread.
+    """
+
+    def __init__(self, host=HOST, port=PORT, queue_size=constants.OUTBOUND_QUEUE_SIZE, policy=DROP, shards=0,
+                 backlog=1024):
+        if policy == BLOCK:
+            # Handlers run on the event loop, blocking one of them would stall the writers it waits on
+            raise ValueError('The asyncio server can not block on slow consumers')
+        super().__init__(host, port, queue_size, policy, shards)
+        self.backlog = backlog
+        self.loop = None
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.on_connect, self.host, self.port, backlog=self.backlog)
+        logger.info('start listening for connections on %s:%d', self.host, self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def on_connect(self, reader, writer):
+        listener = AsyncMessageListener(reader, writer, self, OutboundQueue(self.queue_size, self.policy))
+        self.players[listener.socket] = Player(listener)
+        write_task = asyncio.ensure_future(listener.write())
+        await listener.listen()
+        await write_task
 
 
 if __name__ == '__main__':
-    Server()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--asyncio', action='store_true', help='serve all connections from one event loop')
+    parser.add_argument('--queue-size', type=int, default=constants.OUTBOUND_QUEUE_SIZE,
+                        help='messages buffered per client before the slow consumer policy kicks in')
+    parser.add_argument('--slow-consumers', choices=POLICIES, default=DROP)
+    parser.add_argument('--shards', type=int, default=0, help='worker processes to run the sessions on')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='localhost port serving the metrics as JSON, 0 to turn it off')
+    parser.add_argument('--log-file', default='server.log')
+    parser.add_argument('--log-level', default='INFO')
+    parser.add_argument('--log', action='append', default=[], metavar='SUBSYSTEM=LEVEL',
+                        help='level for a single subsystem, like net=DEBUG')
+    args = parser.parse_args()
+
+    log.setup(args.log_file, args.log_level, log.parse_levels(args.log))
+
+    server_class = AsyncServer if args.asyncio else Server
+    server = server_class(args.host, args.port, args.queue_size, args.slow_consumers, args.shards)
+    if args.metrics_port:
+        server.serve_metrics(args.metrics_port)
+    server.serve_forever()
@@ -0,0 +1,97 @@
+'''Snapshots module sending the state of the world as changes since what a client confirmed
+
+A snapshot is the state of every entity a client can see at one tick, a dictionary of field
+dictionaries by entity name. Clients acknowledge the snapshots they receive, and every next one is
+sent as the fields that changed since the newest acknowledged one. Snapshots still in flight don't
+count, so a lost or late one never leaves a client with a broken state. When a client hasn't
+acknowledged anything the server still remembers, it gets a full snapshot instead.
+'''
+
+import collections
+import threading
+
+
+def diff(baseline: dict, state: dict):
+    """Return the fields of state that differ from baseline by entity, and the entities that are gone."""
+    changed = {}
+    for name, fields in state.items():
+        before = baseline.get(name)
+        if before is None:
+            changed[name] = fields
+        elif before != fields:
+            changed[name] = {key: value for key, value in fields.items() if before.get(key) != value}
+    removed = [name for name in baseline if name not in state]
+    return changed, removed
+
+
+def patch(baseline: dict, changed: dict, removed) -> dict:
+    """Counterpart of diff, returns a new state without touching baseline."""
+    state = {name: fields for name, fields in baseline.items() if name not in removed}
+    for name, fields in changed.items():
+        state[name] = dict(state.get(name, {}), **fields)
+    return state
+
+
+class SnapshotHistory:
+    """Server side record of the snapshots sent to one client, and which of them came back acknowledged."""
+
+    def __init__(self, size=32):
+        self.size = size
+        self.acked = None
+        self._sent = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def ack(self, tick):
+        with self._lock:
+            if tick in self._sent and (self.acked is None or tick > self.acked):
+                self.acked = tick
+                # Nothing older than the acknowledged snapshot is needed as a baseline anymore
+                while next(iter(self._sent)) != tick:
+                    self._sent.popitem(last=False)
+
+    def delta(self, tick, state: dict):
+        """Return the SNAPSHOT payload bringing the client to state, None when it already has it."""
+        with self._lock:
+            if self._sent and next(reversed(self._sent.values())) == state:
+                return None
+
+            base = self.acked
+            changed, removed = diff(self._sent[base] if base is not None else {}, state)
+            self._sent[tick] = state
+            while len(self._sent) > self.size:
+                # Too far behind on acknowledging, the next one will have to be full
+                if next(iter(self._sent)) == self.acked:
+                    self.acked = None
+                self._sent.popitem(last=False)
+
+        return {'tick': tick, 'base': base, 'entities': changed, 'removed': removed}
+
+
+class SnapshotReceiver:
+    """Client side counterpart, rebuilding the state from the payloads."""
+
+    def __init__(self, size=32):
+        self.size = size
+        self.state = {}
+        self.tick = None
+        self._received = collections.OrderedDict()
+
+    def apply(self, payload) -> bool:
+        """Apply a SNAPSHOT payload, returns False when its baseline is unknown and it has to be ignored."""
+        base = payload['base']
+        if base is None:
+            baseline = {}
+        elif base in self._received:
+            baseline = self._received[base]
+        else:
+            return False
+
+        self.state = patch(baseline, payload['entities'], payload['removed'])
+        self.tick = payload['tick']
+        self._received[self.tick] = self.state
+        # The server never goes back further than the baseline it just used
+        while base is not None and next(iter(self._received)) != base:
+            self._received.popitem(last=False)
+        while len(self._received) > self.size:
+            self._received.popitem(last=False)
+        return True
@@ -0,0 +1,93 @@
+'''Spatial module with an index of where entities are on a map
+
+Entities are kept in buckets of cell_size by cell_size tiles, so finding what is at or near a
+position only looks at the few buckets overlapping the area instead of at every entity.
+'''
+
+from collections import defaultdict
+
+
+class SpatialIndex:
+    """Uniform grid of buckets holding the entities inside them.
+
+    The index doesn't watch the entities, whoever moves one should call move so it ends up in the
+    right bucket. Queries return a list of the entities found.
+    """
+
+    def __init__(self, cell_size=8):
+        self.cell_size = cell_size
+        self._buckets = defaultdict(set)
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, entity):
+        return entity in self._positions
+
+    def _bucket(self, x, y):
+        return x // self.cell_size, y // self.cell_size
+
+    def position(self, entity):
+        return self._positions[entity]
+
+    def insert(self, entity, x=None, y=None):
+        """Add an entity at (x, y), or at its own position when none is given."""
+        if entity in self._positions:
+            self.remove(entity)
+        x = entity.x if x is None else x
+        y = entity.y if y is None else y
+        self._positions[entity] = (x, y)
+        self._buckets[self._bucket(x, y)].add(entity)
+
+    def remove(self, entity):
+        x, y = self._positions.pop(entity)
+        key = self._bucket(x, y)
+        bucket = self._buckets[key]
+        bucket.discard(entity)
+        if not bucket:
+            del self._buckets[key]
+
+    def move(self, entity, x, y):
+        old = self._positions[entity]
+        self._positions[entity] = (x, y)
+        old_key, key = self._bucket(*old), self._bucket(x, y)
+        if old_key != key:
+            bucket = self._buckets[old_key]
+            bucket.discard(entity)
+            if not bucket:
+                del self._buckets[old_key]
+            self._buckets[key].add(entity)
+
+    def at(self, x, y) -> list:
+        bucket = self._buckets.get(self._bucket(x, y), ())
+        return [e for e in bucket if self._positions[e] == (x, y)]
+
+    def in_rect(self, x0, y0, x1, y1) -> list:
+        """Return the entities with x0 <= x <= x1 and y0 <= y <= y1."""
+        found = []
+        bx0, by0 = self._bucket(x0, y0)
+        bx1, by1 = self._bucket(x1, y1)
+        if (bx1 - bx0 + 1) * (by1 - by0 + 1) > len(self._buckets):
+            # Large areas have more buckets than there are occupied ones
+            keys = [k for k in self._buckets if bx0 <= k[0] <= bx1 and by0 <= k[1] <= by1]
+        else:
+            keys = [(bx, by) for bx in range(bx0, bx1 + 1) for by in range(by0, by1 + 1)]
+
+        for key in keys:
+            for entity in self._buckets.get(key, ()):
+                x, y = self._positions[entity]
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    found.append(entity)
+        return found
+
+    def in_radius(self, x, y, radius) -> list:
+        """Return the entities within a euclidean distance of radius from (x, y)."""
+        r2 = radius * radius
+        found = []
+        reach = int(radius)
+        for entity in self.in_rect(x - reach, y - reach, x + reach, y + reach):
+            ex, ey = self._positions[entity]
+            if (ex - x) ** 2 + (ey - y) ** 2 <= r2:
+                found.append(entity)
+        return found
@@ -0,0 +1,107 @@
+import unittest
+
+import numpy as np
+
+from components import game
+from components.map import Map
+
+ROWS = [
+    '#######',
+    '#     #',
+    '#  #  #',
+    '#     #',
+    '#######'
+]
+
+
+def player_at(name, x, y):
+    player = game.Player(name, (255, 255, 255), name)
+    player.entity.x, player.entity.y = x, y
+    return player
+
+
+class GameTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state = game.GameState(Map('test', rows=ROWS))
+
+    def add(self, name, x, y):
+        player = player_at(name, x, y)
+        self.state.add_player(player, spawn=False)
+        return player
+
+    def validate(self, *moves):
+        return self.state.validate_moves([player for player, _ in moves],
+                                         np.array([target for _, target in moves])).tolist()
+
+
+class ValidateMovesTest(GameTest):
+
+    def test_free_tile(self):
+        a = self.add('a', 1, 1)
+        self.assertEqual(self.validate((a, (2, 1))), [True])
+
+    def test_wall_and_bounds(self):
+        a = self.add('a', 2, 1)
+        self.assertEqual(self.validate((a, (3, 2))), [False])
+        self.assertEqual(self.validate((a, (-1, 1))), [False])
+        self.assertEqual(self.validate((a, (2, 9))), [False])
+
+    def test_contested(self):
+        a, b = self.add('a', 1, 1), self.add('b', 3, 1)
+        self.assertEqual(self.validate((a, (2, 1)), (b, (2, 1))), [False, False])
+
+    def test_standing_player_blocks(self):
+        a = self.add('a', 1, 1)
+        self.add('b', 2, 1)
+        self.assertEqual(self.validate((a, (2, 1))), [False])
+
+    def test_following_a_moving_player(self):
+        a, b = self.add('a', 1, 1), self.add('b', 2, 1)
+        self.assertEqual(self.validate((a, (2, 1)), (b, (3, 1))), [True, True])
+
+    def test_blocked_chain(self):
+        a, b = self.add('a', 1, 1), self.add('b', 2, 1)
+        self.add('c', 3, 1)
+        # c stays, so b can't move, so a can't either
+        self.assertEqual(self.validate((a, (2, 1)), (b, (3, 1))), [False, False])
+
+
+class ResolveTest(GameTest):
+
+    def move(self, player, value):
+        return player, game.Action('MOVE', value)
+
+    def test_step(self):
+        a = self.add('a', 1, 1)
+        results = self.state.resolve([self.move(a, [2, 2])])
+        self.assertEqual(results, [{'player': 'a', 'type': 'MOVE', 'ok': True, 'x': 2, 'y': 2}])
+
+    def test_no_teleporting(self):
+        a = self.add('a', 1, 1)
+        self.assertFalse(self.state.resolve([self.move(a, [5, 3])])[0]['ok'])
+        self.assertFalse(self.state.resolve([self.move(a, [1, 1])])[0]['ok'])
+        self.assertEqual((a.entity.x, a.entity.y), (1, 1))
+
+    def test_one_move_per_tick(self):
+        a = self.add('a', 1, 1)
+        results = self.state.resolve([self.move(a, [2, 1]), self.move(a, [3, 1])])
+        self.assertEqual([r['ok'] for r in results], [True, False])
+        self.assertEqual((a.entity.x, a.entity.y), (2, 1))
+
+    def test_malformed_moves_only_fail_themselves(self):
+        a, b = self.add('a', 1, 1), self.add('b', 5, 3)
+        for value in ([1], None, 'ab', [1.5, 1], [True, 1], [2 ** 80, 1], [[1], [2]]):
+            # b walks back and forth, every one of its moves is fine
+            results = self.state.resolve([self.move(a, value), self.move(b, [9 - b.entity.x, 3])])
+            self.assertEqual([r['ok'] for r in results], [False, True], value)
+
+    def test_spatial_index_follows(self):
+        a = self.add('a', 1, 1)
+        self.state.resolve([self.move(a, [2, 1])])
+        self.assertEqual(self.state.entities.at(2, 1), [a.entity])
+        self.assertEqual(self.state.entities.at(1, 1), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
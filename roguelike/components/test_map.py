@@ -0,0 +1,54 @@
+import unittest
+
+from components.map import FLOOR, WALL, Map
+
+ROWS = [
+    '#####',
+    '#   #',
+    '#####'
+]
+
+
+class MapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.map = Map('test', 's', rows=ROWS, history=4)
+
+    def test_changes_since(self):
+        self.map.set_tile(1, 1, WALL)
+        self.map.set_tile(2, 1, WALL)
+        self.assertEqual(self.map.changes_since(1), {(2, 1)})
+        self.assertEqual(self.map.changes_since(0), {(1, 1), (2, 1)})
+        self.assertEqual(self.map.changes_since(2), set())
+
+    def test_changes_since_needs_the_history(self):
+        for _ in range(3):
+            self.map.set_tile(1, 1, WALL)
+            self.map.set_tile(1, 1, FLOOR)
+        self.assertIsNone(self.map.changes_since(1))
+        self.assertIsNone(self.map.changes_since(7))
+
+    def test_same_tile_is_no_change(self):
+        self.map.set_tile(1, 1, FLOOR)
+        self.assertEqual(self.map.version, 0)
+
+    def test_apply_delta(self):
+        client = Map('test', 's', rows=ROWS)
+        self.map.set_tile(1, 1, WALL)
+        self.map.set_tile(3, 1, WALL)
+        self.assertTrue(client.apply_delta(self.map.tile_delta(0, self.map.changes_since(0))))
+        self.assertEqual(client.version, 2)
+        self.assertEqual(client.tiles.tolist(), self.map.tiles.tolist())
+        self.assertFalse(client.walkable[1, 1])
+
+    def test_delta_has_to_follow_on(self):
+        client = Map('test', 's', rows=ROWS)
+        self.map.set_tile(1, 1, WALL)
+        self.map.set_tile(3, 1, WALL)
+        self.assertFalse(client.apply_delta(self.map.tile_delta(1, self.map.changes_since(1))))
+        self.assertEqual(client.version, 0)
+        self.assertTrue(client.walkable[1, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+import threading
+import unittest
+
+import constants
+from components import net_utils
+from components.net_utils import (BINARY, BLOCK, DISCONNECT, DROP, JSON, HEADER, OutboundQueue, decode_message, encode,
+                                  frame_size, send_frames)
+
+
+def round_trip(message, codec=BINARY):
+    return decode_message(encode(message, codec)[HEADER.size:])
+
+
+class BinaryCodecTest(unittest.TestCase):
+
+    def test_values(self):
+        for value in (None, True, False, 0, -1, 2 ** 31 - 1, -2 ** 31, 2 ** 31, -2 ** 40, 1.5, '', 'ünïcode',
+                      b'\x00\xff', [], [1, [2, [3]]], {}, {'a': {'b': [None, 'c']}}):
+            out = bytearray()
+            net_utils._pack_value(out, value)
+            self.assertEqual(net_utils._unpack_value(out, 0), (value, len(out)), value)
+
+    def test_long_sizes(self):
+        # Sizes from 256 up get the long tags
+        for value in ('x' * 300, b'y' * 300, list(range(300)), {str(i): i for i in range(300)}):
+            out = bytearray()
+            net_utils._pack_value(out, value)
+            self.assertEqual(net_utils._unpack_value(out, 0)[0], value)
+
+    def test_int_keys(self):
+        out = bytearray()
+        net_utils._pack_value(out, {1: 'a', 2: 'b'})
+        self.assertEqual(net_utils._unpack_value(out, 0)[0], {1: 'a', 2: 'b'})
+
+    def test_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            net_utils._pack_value(bytearray(), object())
+
+    def test_map(self):
+        payload = {'dungeon_id': 'd', 'session_id': 's', 'version': 3, 'tiles': ['###', '# #', '###']}
+        self.assertEqual(round_trip((constants.MAP, payload)), [constants.MAP, payload])
+
+    def test_empty_map(self):
+        payload = {'dungeon_id': 'd', 'version': 0, 'tiles': []}
+        self.assertEqual(round_trip((constants.MAP, payload)), [constants.MAP, payload])
+
+    def test_map_delta(self):
+        payload = {'session_id': 's', 'from': 1, 'version': 2, 'tiles': [[0, 0, '#'], [65535, 7, ' ']]}
+        self.assertEqual(round_trip((constants.MAP_DELTA, payload)), [constants.MAP_DELTA, payload])
+
+    def test_every_event_type(self):
+        for event_type in constants.EVENT_TYPES:
+            if event_type not in BINARY.payload_packers:
+                self.assertEqual(round_trip((event_type, {'a': 1})), [event_type, {'a': 1}])
+
+    def test_unknown_event_type(self):
+        self.assertEqual(round_trip(('SOMETHING_NEW', [1])), ['SOMETHING_NEW', [1]])
+
+    def test_json_and_binary_frames_are_told_apart(self):
+        message = (constants.GLOBAL_CHAT, {'message': 'hi'})
+        self.assertEqual(round_trip(message, JSON), round_trip(message, BINARY))
+
+
+class FrameTest(unittest.TestCase):
+
+    def test_frame_event_type(self):
+        for codec in (JSON, BINARY):
+            frame = encode((constants.SNAPSHOT, {'tick': 1}), codec)
+            self.assertEqual(net_utils.frame_event_type(frame), constants.SNAPSHOT)
+
+    def test_frame_size(self):
+        self.assertEqual(frame_size(HEADER.pack(constants.MAX_FRAME_SIZE)), constants.MAX_FRAME_SIZE)
+        with self.assertRaises(ConnectionError):
+            frame_size(HEADER.pack(0xFFFFFFF0))
+
+
+class TrickleSocket:
+    """Socket taking at most a few bytes per sendmsg call, like a full send buffer."""
+
+    def __init__(self, per_call):
+        self.per_call = per_call
+        self.calls = 0
+        self.data = bytearray()
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        taken = b''.join(bytes(buffer) for buffer in buffers)[:self.per_call]
+        self.data += taken
+        return len(taken)
+
+
+class PlainSocket:
+    """Socket without vectored writes."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def sendall(self, data):
+        self.data += data
+
+
+class SendFramesTest(unittest.TestCase):
+
+    def test_partial_writes(self):
+        frames = [b'abc', b'', b'defgh', b'i']
+        for per_call in range(1, 10):
+            conn = TrickleSocket(per_call)
+            send_frames(conn, frames)
+            self.assertEqual(conn.data, b'abcdefghi', per_call)
+            self.assertEqual(conn.calls, -(-9 // per_call))
+
+    def test_without_sendmsg(self):
+        conn = PlainSocket()
+        send_frames(conn, [b'abc', b'def'])
+        self.assertEqual(conn.data, b'abcdef')
+
+
+class OutboundQueueTest(unittest.TestCase):
+
+    def blocked_put(self, queue, frame):
+        """Put frame on another thread, returns the thread and what put returned once it's done."""
+        result = []
+        thread = threading.Thread(target=lambda: result.append(queue.put(frame)), daemon=True)
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        return thread, result
+
+    def test_take(self):
+        queue = OutboundQueue()
+        for frame in (b'a', b'b', b'c'):
+            self.assertTrue(queue.put(frame))
+        self.assertEqual(queue.take(limit=2), [b'a', b'b'])
+        self.assertEqual(queue.take(), [b'c'])
+        self.assertEqual(queue.take(block=False), [])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            OutboundQueue(policy='wait')
+
+    def test_drop(self):
+        queue = OutboundQueue(size=2, policy=DROP)
+        self.assertEqual([queue.put(frame) for frame in (b'a', b'b', b'c')], [True, True, False])
+        self.assertEqual(queue.dropped, 1)
+        self.assertFalse(queue.closed)
+        self.assertEqual(queue.take(), [b'a', b'b'])
+        self.assertTrue(queue.put(b'd'))
+
+    def test_disconnect(self):
+        closed = []
+        queue = OutboundQueue(size=1, policy=DISCONNECT)
+        queue.on_close = lambda: closed.append(True)
+        self.assertTrue(queue.put(b'a'))
+        self.assertFalse(queue.put(b'b'))
+        self.assertTrue(queue.closed)
+        self.assertEqual(closed, [True])
+        self.assertFalse(queue.put(b'c'))
+        self.assertEqual(closed, [True])
+
+    def test_block(self):
+        queue = OutboundQueue(size=1, policy=BLOCK)
+        queue.put(b'a')
+        thread, result = self.blocked_put(queue, b'b')
+        self.assertEqual(queue.take(), [b'a'])
+        thread.join(1)
+        self.assertEqual(result, [True])
+        self.assertEqual(queue.take(), [b'b'])
+
+    def test_close_releases_blocked_put(self):
+        queue = OutboundQueue(size=1, policy=BLOCK)
+        queue.put(b'a')
+        thread, result = self.blocked_put(queue, b'b')
+        queue.close()
+        thread.join(1)
+        self.assertEqual(result, [False])
+
+    def test_take_after_close(self):
+        queue = OutboundQueue()
+        queue.put(b'a')
+        queue.close()
+        # Doesn't block, what was still queued is gone
+        self.assertEqual(queue.take(), [])
+        self.assertEqual(len(queue), 0)
+
+    def test_close_wakes_take(self):
+        queue = OutboundQueue()
+        result = []
+        thread = threading.Thread(target=lambda: result.append(queue.take()), daemon=True)
+        thread.start()
+        queue.close()
+        thread.join(1)
+        self.assertEqual(result, [[]])
+
+    def test_notify(self):
+        notified = []
+        queue = OutboundQueue(size=1)
+        queue.notify = lambda: notified.append(len(queue))
+        queue.put(b'a')
+        queue.put(b'b')
+        queue.close()
+        self.assertEqual(notified, [1, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import collections
+import unittest
+
+import numpy as np
+
+from components import pathfinding
+from components.map import FLOOR, Map
+from components.pathfinding import NEIGHBOURS, Pathfinder, distance_field, flee_field, step
+
+ROWS = [
+    '#########',
+    '#   #   #',
+    '# # # # #',
+    '#       #',
+    '####### #',
+    '#       #',
+    '#########'
+]
+
+
+def walkable(rows):
+    return np.array([[char != '#' for char in row] for row in rows])
+
+
+def bfs(walkable, goals):
+    """Plain breadth first search to check the fields against."""
+    height, width = walkable.shape
+    field = np.full(walkable.shape, np.inf)
+    queue = collections.deque()
+    for x, y in goals:
+        if walkable[y, x]:
+            field[y, x] = 0
+            queue.append((x, y))
+    while queue:
+        x, y = queue.popleft()
+        for dx, dy in NEIGHBOURS:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < width and 0 <= ny < height and walkable[ny, nx] and field[ny, nx] == np.inf:
+                field[ny, nx] = field[y, x] + 1
+                queue.append((nx, ny))
+    return field
+
+
+def slow_relax(field, walkable):
+    """Relax the whole map over and over until nothing changes, the definition of _relax."""
+    field = np.where(walkable, field, np.inf)
+    while True:
+        lowest = field.copy()
+        height, width = field.shape
+        for y in range(height):
+            for x in range(width):
+                for dx, dy in NEIGHBOURS:
+                    nx, ny = x + dx, y + dy
+                    if walkable[y, x] and 0 <= nx < width and 0 <= ny < height:
+                        lowest[y, x] = min(lowest[y, x], field[ny, nx] + 1)
+        if np.array_equal(lowest, field):
+            return field
+        field = lowest
+
+
+class DistanceFieldTest(unittest.TestCase):
+
+    def test_small_map(self):
+        field = distance_field(walkable(ROWS), [(1, 1)])
+        self.assertEqual(field[1, 1], 0)
+        self.assertEqual(field[3, 3], 3)
+        # Through the gap, down the corridor on the right and back along the bottom
+        self.assertEqual(field[5, 1], 12)
+        self.assertEqual(field[0, 0], np.inf)
+
+    def test_matches_breadth_first_search(self):
+        rng = np.random.default_rng(1)
+        for _ in range(100):
+            height, width = rng.integers(1, 20, 2)
+            tiles = rng.random((height, width)) < 0.7
+            goals = [(int(rng.integers(width)), int(rng.integers(height))) for _ in range(rng.integers(0, 4))]
+            np.testing.assert_array_equal(distance_field(tiles, goals), bfs(tiles, goals))
+
+    def test_unreachable(self):
+        tiles = walkable(['   #   '])
+        field = distance_field(tiles, [(0, 0)])
+        self.assertEqual(field.tolist(), [[0, 1, 2, np.inf, np.inf, np.inf, np.inf]])
+
+    def test_goal_in_a_wall(self):
+        self.assertTrue(np.isinf(distance_field(walkable(ROWS), [(0, 0)])).all())
+
+
+class FleeFieldTest(unittest.TestCase):
+
+    def test_matches_relaxing_until_nothing_changes(self):
+        rng = np.random.default_rng(2)
+        for _ in range(30):
+            height, width = rng.integers(1, 10, 2)
+            tiles = rng.random((height, width)) < 0.7
+            goals = [(int(rng.integers(width)), int(rng.integers(height)))]
+            field = distance_field(tiles, goals) * pathfinding.FLEE_FACTOR
+            field[np.isneginf(field)] = np.inf
+            np.testing.assert_array_equal(flee_field(tiles, goals), slow_relax(field, tiles))
+
+    def test_leads_away(self):
+        tiles = walkable([' ' * 10])
+        field = flee_field(tiles, [(3, 0)])
+        self.assertEqual(step(field, 3, 0), (4, 0))
+        self.assertEqual(step(field, 9, 0), None)
+
+
+class StepTest(unittest.TestCase):
+
+    def test_follows_the_field_to_the_goal(self):
+        field = distance_field(walkable(ROWS), [(1, 1)])
+        x, y = 1, 5
+        path = []
+        while (x, y) != (1, 1):
+            x, y = step(field, x, y)
+            path.append((x, y))
+        self.assertEqual(len(path), 12)
+
+    def test_ties_go_the_same_way(self):
+        # Both goals are one step away, the first direction in NEIGHBOURS wins
+        field = distance_field(walkable(['   '] * 3), [(1, 0), (0, 1)])
+        self.assertEqual(step(field, 1, 1), (1, 0))
+
+    def test_at_the_goal(self):
+        field = distance_field(walkable(ROWS), [(1, 1)])
+        self.assertIsNone(step(field, 1, 1))
+
+
+class PathfinderTest(unittest.TestCase):
+
+    def test_same_as_building_the_fields(self):
+        game_map = Map('test', rows=ROWS)
+        paths = Pathfinder(game_map)
+        goals = [(1, 1), (7, 5)]
+        np.testing.assert_array_equal(paths.toward(goals), distance_field(game_map.walkable, goals))
+        np.testing.assert_array_equal(paths.away_from(goals), flee_field(game_map.walkable, goals))
+
+    def test_cached_until_the_map_changes(self):
+        game_map = Map('test', rows=ROWS)
+        paths = Pathfinder(game_map)
+        field = paths.toward([(1, 1)])
+        self.assertIs(paths.toward([(1, 1)]), field)
+        self.assertFalse(field.flags.writeable)
+
+        # A shortcut into the bottom corridor
+        game_map.set_tile(4, 4, FLOOR)
+        self.assertEqual(paths.toward([(1, 1)])[5, 1], 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+
+from components.snapshots import SnapshotHistory, SnapshotReceiver, diff, patch
+
+
+class DiffTest(unittest.TestCase):
+
+    def test_changed_fields_only(self):
+        baseline = {'1': {'x': 1, 'y': 1, 'char': '@'}, '2': {'x': 5, 'y': 5, 'char': '@'}}
+        state = {'1': {'x': 2, 'y': 1, 'char': '@'}, '2': {'x': 5, 'y': 5, 'char': '@'}}
+        self.assertEqual(diff(baseline, state), ({'1': {'x': 2}}, []))
+
+    def test_added_and_removed(self):
+        changed, removed = diff({'1': {'x': 1}}, {'2': {'x': 2}})
+        self.assertEqual(changed, {'2': {'x': 2}})
+        self.assertEqual(removed, ['1'])
+
+    def test_patch_undoes_diff(self):
+        baseline = {'1': {'x': 1, 'y': 1}, '2': {'x': 5, 'y': 5}, '3': {'x': 0, 'y': 0}}
+        state = {'1': {'x': 1, 'y': 2}, '3': {'x': 0, 'y': 0}, '4': {'x': 9, 'y': 9}}
+        self.assertEqual(patch(baseline, *diff(baseline, state)), state)
+
+    def test_patch_leaves_baseline_alone(self):
+        baseline = {'1': {'x': 1}}
+        patch(baseline, {'1': {'x': 2}}, [])
+        self.assertEqual(baseline, {'1': {'x': 1}})
+
+
+class HistoryTest(unittest.TestCase):
+
+    def test_first_snapshot_is_full(self):
+        payload = SnapshotHistory().delta(1, {'1': {'x': 1}})
+        self.assertEqual(payload, {'tick': 1, 'base': None, 'entities': {'1': {'x': 1}}, 'removed': []})
+
+    def test_delta_against_acknowledged(self):
+        history = SnapshotHistory()
+        history.delta(1, {'1': {'x': 1, 'y': 1}})
+        history.ack(1)
+        history.delta(2, {'1': {'x': 2, 'y': 1}})
+        # Tick 2 wasn't acknowledged, so tick 3 still goes against tick 1
+        payload = history.delta(3, {'1': {'x': 3, 'y': 1}})
+        self.assertEqual(payload['base'], 1)
+        self.assertEqual(payload['entities'], {'1': {'x': 3}})
+
+    def test_unchanged_state_sends_nothing(self):
+        history = SnapshotHistory()
+        history.delta(1, {'1': {'x': 1}})
+        self.assertIsNone(history.delta(2, {'1': {'x': 1}}))
+
+    def test_too_old_baseline_sends_full(self):
+        history = SnapshotHistory(size=4)
+        history.delta(1, {'1': {'x': 1}})
+        history.ack(1)
+        for tick in range(2, 6):
+            history.delta(tick, {'1': {'x': tick}})
+        payload = history.delta(6, {'1': {'x': 6}})
+        self.assertIsNone(payload['base'])
+        self.assertEqual(payload['entities'], {'1': {'x': 6}})
+
+    def test_unknown_ack_is_ignored(self):
+        history = SnapshotHistory()
+        history.delta(1, {'1': {'x': 1}})
+        history.ack(7)
+        self.assertIsNone(history.acked)
+
+
+class ReceiverTest(unittest.TestCase):
+
+    def test_follows_history(self):
+        history, receiver = SnapshotHistory(size=4), SnapshotReceiver(size=4)
+        for tick in range(1, 20):
+            state = {str(i): {'x': tick * i % 7} for i in range(tick % 5)}
+            payload = history.delta(tick, state)
+            if payload is not None:
+                self.assertTrue(receiver.apply(payload))
+                # Only every third one comes back acknowledged
+                if tick % 3 == 0:
+                    history.ack(tick)
+            self.assertEqual(receiver.state, state)
+
+    def test_unknown_baseline_is_refused(self):
+        receiver = SnapshotReceiver()
+        self.assertFalse(receiver.apply({'tick': 5, 'base': 4, 'entities': {}, 'removed': []}))
+        self.assertIsNone(receiver.tick)
+
+
+if __name__ == '__main__':
+    unittest.main()
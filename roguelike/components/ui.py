@@ -1,3 +1,6 @@
+import collections
+import textwrap
+
 import tcod
 from tcod.console import Console
 from tcod.event import EventDispatch, KeyDown, TextInput
@@ -10,6 +13,14 @@ def calculate_middle(console, dimensions: tuple) -> tuple:
     return new_w, new_h
 
 
+def wrap_text(text: str, width: int) -> list:
+    """Word wrap text into lines of at most width characters, keeping the newlines it already has."""
+    lines = []
+    for paragraph in text.split('\n'):
+        lines.extend(textwrap.wrap(paragraph, width) or [''])
+    return lines
+
+
 class MenuItem:
 
     def __init__(self, x=0, y=0):
@@ -73,35 +84,99 @@ class Input(MenuItem, EventDispatch):
             self.text += event.text
 
 
+class MessageLog:
+    """Ring buffer remembering the last capacity messages, word wrapped once when they're added.
+
+    The wrapped lines are cached for the width they were wrapped at, only asking for another width
+    wraps all messages again.
+    """
+
+    def __init__(self, capacity: int = 500, width: int = 80):
+        self.width = width
+        self._messages = collections.deque(maxlen=capacity)
+        self._lines = []
+
+    def __len__(self):
+        return len(self._lines)
+
+    def append(self, message: str) -> int:
+        """Add a message, returns the number of lines that fell off the start to make room for it."""
+        dropped = 0
+        if len(self._messages) == self._messages.maxlen:
+            dropped = len(self._messages[0][1])
+            del self._lines[:dropped]
+        wrapped = wrap_text(message, self.width)
+        self._messages.append((message, wrapped))
+        self._lines.extend(wrapped)
+        return dropped
+
+    def lines(self, start: int, count: int, width: int = None) -> list:
+        if width is not None and width != self.width:
+            self._rewrap(width)
+        return self._lines[start:start + count]
+
+    def _rewrap(self, width):
+        self.width = width
+        self._messages = collections.deque(((message, wrap_text(message, width)) for message, _ in self._messages),
+                                           maxlen=self._messages.maxlen)
+        self._lines = [line for _, wrapped in self._messages for line in wrapped]
+
+
+class Typewriter:
+    """Reveals a text one character at a time, wrapped once up front instead of on every frame."""
+
+    def __init__(self, text: str, width: int):
+        self.lines = wrap_text(text, width)
+
+    def __len__(self):
+        return sum(len(line) + 1 for line in self.lines)
+
+    def draw(self, console: Console, x: int, y: int, count: int, fg=None):
+        """Draw the first count characters of the text with its top left corner at x, y."""
+        for row, line in enumerate(self.lines):
+            if count <= 0:
+                break
+            console.print(x, y + row, line[:count], fg=fg)
+            count -= len(line) + 1
+
+
 class Textbox(EventDispatch):
-    """Textbox displays a newline separated list of messages.
+    """Textbox displays a list of messages, the newest at the bottom.
 
     Textbox is built to create scroll capability as soon as the list spills over the height of the widget.
+    Only the last capacity messages are kept, see MessageLog.
     """
 
-    messages = []
-
-    def __init__(self, root_console: Console):
+    def __init__(self, root_console: Console, capacity: int = 500):
         self._console = root_console
+        self.log = MessageLog(capacity, root_console.width - 2)
         self.scroll_offset = 0
 
+    @property
+    def page_size(self):
+        return self._console.height - 3
+
     def add_message(self, message):
-        self.messages.append(message)
-        if len(self.messages) > self._console.height - 3:
-            self.scroll_offset = len(self.messages) - (self._console.height - 3)
+        following = self.scroll_offset >= len(self.log) - self.page_size
+        dropped = self.log.append(message)
+        if following:
+            self.scroll_offset = max(0, len(self.log) - self.page_size)
+        else:
+            # Scrolled up, keep showing the same lines, which moved up by what fell off the start
+            self.scroll_offset = max(0, self.scroll_offset - dropped)
 
     def draw(self, root_console):
         self._console.draw_frame(0, 0, self._console.width, self._console.height)
-        self._console.print_box(1, 1, self._console.width - 2, self._console.height - 3,
-                                ''.join(self.messages[self.scroll_offset:]),
-                                fg=(255, 244, 122))
-        if len(self.messages) > self._console.height - 3:
+        lines = self.log.lines(self.scroll_offset, self.page_size, self._console.width - 2)
+        for row, line in enumerate(lines, 1):
+            self._console.print(1, row, line, fg=(255, 244, 122))
+        if len(self.log) > self.page_size:
             self._console.print(self._console.width - 2, 1, chr(tcod.CHAR_ARROW_N))
             self._console.print(self._console.width - 2, self._console.height - 3, chr(tcod.CHAR_ARROW_S))
 
     def ev_keydown(self, event: KeyDown) -> None:
         if event.sym == tcod.event.K_DOWN:
-            if self.scroll_offset < len(self.messages) - (self._console.height - 3):
+            if self.scroll_offset < len(self.log) - self.page_size:
                 self.scroll_offset += 1
         if event.sym == tcod.event.K_UP:
             if self.scroll_offset > 0:
@@ -148,7 +223,8 @@ class Menu(EventDispatch):
         menu.hidden = False
         return menu
 
-    def draw(self):
+    def draw(self, console=None):
+        """Draw the menu onto console, the root console it was created for by default."""
         if not self.hidden:
             self.layer_console.draw_frame(0, 0, self.width, self.height, title=self.title, )
             for index, elem in enumerate(self.contents, 0):
@@ -157,7 +233,7 @@ class Menu(EventDispatch):
                 else:
                     elem.col = (255, 255, 255)
                 elem.draw(self.layer_console)
-            self.layer_console.blit(self.root_console, self.x, self.y)
+            self.layer_console.blit(console if console is not None else self.root_console, self.x, self.y)
 
     def ev_textinput(self, event: TextInput) -> None:
         self.contents[self.selected_index].dispatch(event)
@@ -1,21 +1,41 @@
-import tcod.constants
-
 # Network related constants
 
 GLOBAL_CHAT = "GLOBAL_CHAT"
 SERVER = "SERVER"
 LOBBIES = "LOBBIES"
 MAP = "MAP"
+MAP_DELTA = "MAP_DELTA"
+MAP_RESYNC = "MAP_RESYNC"
 
 PLAYER_INTENT = "PLAYER_INTENT"
 PLAYER_RESOLVE = "PLAYER_RESOLVE"
 PLAYER_CONNECT = "PLAYER_CONNECT"
 
+SNAPSHOT = "SNAPSHOT"
+SNAPSHOT_ACK = "SNAPSHOT_ACK"
+
+# Session simulation steps per second
+TICK_RATE = 10
+
+# Intents a player can have waiting to be applied, any more are dropped
+MAX_QUEUED_INTENTS = 8
+
+# How far players can see, in tiles
+FOV_RADIUS = 8
+
+# Messages buffered per connection before the server treats the client as too slow
+OUTBOUND_QUEUE_SIZE = 256
+
+# Largest frame accepted, a bigger length in a header is treated as a broken connection
+MAX_FRAME_SIZE = 1024 * 1024
+
+# Binary codec type tags are the index in this tuple, so only ever append to it
+EVENT_TYPES = (GLOBAL_CHAT, SERVER, LOBBIES, MAP, PLAYER_INTENT, PLAYER_RESOLVE, PLAYER_CONNECT, MAP_DELTA,
+               MAP_RESYNC, SNAPSHOT, SNAPSHOT_ACK)
+
 # Game related constants
 
 SCREEN_WIDTH = 128
 SCREEN_HEIGHT = 72
 GAME_TITLE = "Net Test"
 FONT = 'assets/font_12x12.png'
-
-FONT_OPTIONS_MASK = tcod.FONT_TYPE_GREYSCALE | tcod.FONT_LAYOUT_TCOD
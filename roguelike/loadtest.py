@@ -0,0 +1,263 @@
+'''Load test putting a server under pressure with headless bot clients
+
+Bots speak the regular protocol through net_utils, without tcod, and all run as coroutines on one
+event loop so thousands of them fit on a single machine. They connect, get into sessions in groups,
+ready up and then keep sending moves and chat until the test is over. Afterwards the throughput,
+connect times and round trip times of the requests are reported.
+
+Run a server first, then for instance:
+
+    python loadtest.py --bots 1000 --duration 30
+'''
+
+import argparse
+import asyncio
+import collections
+import math
+import random
+import time
+
+import constants as c
+from components.net_utils import HEADER, CODECS, PREFERRED_CODECS, encode, decode_message
+from components.snapshots import SnapshotReceiver
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows
+    resource = None
+
+MOVES = ((0, -1), (1, 0), (0, 1), (-1, 0))
+
+
+def percentile(values, p):
+    """Nearest rank percentile of a sorted list."""
+    if not values:
+        return float('nan')
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class Stats:
+    """Counters and round trip times shared by all bots."""
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.connect_times = []
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def report(self, duration):
+        print('%d bots connected, %d errors %s' % (len(self.connect_times), sum(self.errors.values()),
+                                                   dict(self.errors) or ''))
+        print('sent     %10.1f msg/s %12.1f bytes/s' % (self.sent / duration, self.bytes_sent / duration))
+        print('received %10.1f msg/s %12.1f bytes/s' % (self.received / duration, self.bytes_received / duration))
+        print()
+        print('%-16s %8s %9s %9s %9s %9s' % ('ms', 'count', 'p50', 'p95', 'p99', 'max'))
+        rows = [('connect', self.connect_times)] + sorted(self.latencies.items())
+        for name, values in rows:
+            values = sorted(values)
+            print('%-16s %8d %9.2f %9.2f %9.2f %9.2f' % (
+                name, len(values), percentile(values, 50) * 1000, percentile(values, 95) * 1000,
+                percentile(values, 99) * 1000, values[-1] * 1000 if values else float('nan')))
+
+
+class Bot:
+    """A single scripted client.
+
+    Requests are timed from sending them until the answer that belongs to them comes in. Answers
+    come back in order, so every kind of request keeps a queue of the times they were sent.
+    """
+
+    def __init__(self, index, group, stats: Stats, args):
+        self.name = 'bot-%d' % index
+        self.id = None
+        self.group = group
+        self.stats = stats
+        self.args = args
+        self.codec = CODECS['json']
+        self.reader = None
+        self.writer = None
+        self.session_id = None
+        self.x, self.y = 5, 5
+        self.world = SnapshotReceiver()
+        self.started = asyncio.Event()
+        self.pending = collections.defaultdict(collections.deque)
+
+    async def run(self, connect_limit: asyncio.Semaphore, stop_at):
+        async with connect_limit:
+            start = time.perf_counter()
+            self.reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+            self.request(c.PLAYER_CONNECT, {'name': self.name, 'codecs': [self.args.codec]})
+            receiver = asyncio.ensure_future(self.receive())
+            try:
+                await self.wait_for(c.PLAYER_CONNECT)
+            except BaseException:
+                receiver.cancel()
+                self.writer.close()
+                raise
+            self.stats.connect_times.append(time.perf_counter() - start)
+
+        try:
+            if self.group.host is None:
+                self.group.host = self
+                self.request(c.LOBBIES, {'action': 'host', 'dungeon_id': 'loadtest'}, 'host')
+                try:
+                    self.group.session_id.set_result(await self.wait_for('host'))
+                except Exception as e:
+                    # Or the rest of the group would wait for the session forever
+                    self.group.session_id.set_exception(e)
+                    raise
+            else:
+                # Shielded, a timeout here shouldn't cancel the session id for the others
+                session_id = await asyncio.wait_for(asyncio.shield(self.group.session_id), self.args.timeout)
+                self.request(c.LOBBIES, {'action': 'join', 'id': session_id}, 'join')
+                await self.wait_for('join')
+
+            await asyncio.wait_for(self.group.all_joined(), self.args.timeout)
+            self.send(c.LOBBIES, {'action': 'ready', 'id': self.session_id, 'value': True})
+            await asyncio.wait_for(self.started.wait(), self.args.timeout)
+            await self.play(stop_at)
+        finally:
+            receiver.cancel()
+            self.writer.close()
+
+    async def play(self, stop_at):
+        interval = 1 / self.args.intent_rate
+        chat_every = round(self.args.intent_rate / self.args.chat_rate) if self.args.chat_rate else 0
+        step = 0
+        while time.monotonic() < stop_at:
+            dx, dy = random.choice(MOVES)
+            self.request(c.PLAYER_INTENT, {'id': self.session_id,
+                                           'action': {'type': 'MOVE', 'value': [self.x + dx, self.y + dy]}})
+            step += 1
+            if chat_every and step % chat_every == 0:
+                self.request(c.GLOBAL_CHAT, {'message': 'hello from %s' % self.name})
+            await asyncio.sleep(interval)
+
+    def send(self, event, payload):
+        frame = encode((event, payload), self.codec)
+        self.writer.write(frame)
+        self.stats.sent += 1
+        self.stats.bytes_sent += len(frame)
+
+    def request(self, event, payload, name=None):
+        self.pending[name or event].append(time.perf_counter())
+        self.send(event, payload)
+
+    def answered(self, name, count=1):
+        pending = self.pending[name]
+        now = time.perf_counter()
+        for _ in range(min(count, len(pending))):
+            self.stats.latencies[name].append(now - pending.popleft())
+        waiter = self.group.waiters.pop((self, name), None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(self.session_id)
+
+    async def wait_for(self, name):
+        waiter = self.group.waiters[self, name] = asyncio.get_running_loop().create_future()
+        return await asyncio.wait_for(waiter, self.args.timeout)
+
+    async def receive(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(HEADER.size)
+                data = await self.reader.readexactly(HEADER.unpack(header)[0])
+                self.stats.received += 1
+                self.stats.bytes_received += HEADER.size + len(data)
+                self.on_message(*decode_message(data))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self.stats.errors[type(e).__name__] += 1
+
+    def on_message(self, event, payload):
+        if event == c.PLAYER_CONNECT:
+            self.codec = CODECS[payload['codec']]
+            self.id = payload['id']
+            self.answered(c.PLAYER_CONNECT)
+        elif event == c.MAP and self.session_id is None:
+            # Hosting and joining both answer with the map of the session
+            self.session_id = payload['session_id']
+            self.answered('host' if self.group.host is self else 'join')
+        elif event == c.LOBBIES and payload.get('start'):
+            self.started.set()
+        elif event == c.GLOBAL_CHAT and payload['player'] == self.name and self.pending[c.GLOBAL_CHAT]:
+            self.answered(c.GLOBAL_CHAT)
+        elif event == c.SNAPSHOT:
+            # Acknowledged like a real client would, or every snapshot would be sent in full
+            if self.world.apply(payload):
+                self.send(c.SNAPSHOT_ACK, {'session_id': payload['session_id'], 'tick': payload['tick']})
+        elif event == c.PLAYER_RESOLVE:
+            own = [r for r in payload['results'] if r['player'] == self.id]
+            if own:
+                self.x, self.y = own[-1]['x'], own[-1]['y']
+                self.answered(c.PLAYER_INTENT, len(own))
+
+
+class Group:
+    """Bots sharing a session, the first one to get going hosts it."""
+
+    def __init__(self, size):
+        self.size = size
+        self.host = None
+        self.session_id = asyncio.get_running_loop().create_future()
+        # A failed host is reported by the host, whether any joiners are still waiting or not
+        self.session_id.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self.waiters = {}
+        self._joined = 0
+        self._everyone_joined = asyncio.Event()
+
+    async def all_joined(self):
+        self._joined += 1
+        if self._joined == self.size:
+            self._everyone_joined.set()
+        await self._everyone_joined.wait()
+
+
+def raise_file_limit(wanted):
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted:
+        target = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+async def run(args):
+    stats = Stats()
+    connect_limit = asyncio.Semaphore(args.connect_concurrency)
+    groups = [Group(min(args.group_size, args.bots - i)) for i in range(0, args.bots, args.group_size)]
+    stop_at = time.monotonic() + args.duration
+
+    start = time.monotonic()
+    bots = [Bot(i, groups[i // args.group_size], stats, args) for i in range(args.bots)]
+    results = await asyncio.gather(*(bot.run(connect_limit, stop_at) for bot in bots), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            stats.errors[type(result).__name__] += 1
+
+    print()
+    stats.report(time.monotonic() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Put a server under load with bot clients.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--bots', type=int, default=100)
+    parser.add_argument('--group-size', type=int, default=4, help='bots per session')
+    parser.add_argument('--duration', type=float, default=10, help='seconds the test runs for, connecting included')
+    parser.add_argument('--intent-rate', type=float, default=5, help='moves per second per bot')
+    parser.add_argument('--chat-rate', type=float, default=0.2, help='chat messages per second per bot')
+    parser.add_argument('--codec', choices=PREFERRED_CODECS, default=PREFERRED_CODECS[0])
+    parser.add_argument('--connect-concurrency', type=int, default=100, help='connections opened at the same time')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds to wait for the lobby to answer')
+    args = parser.parse_args()
+
+    raise_file_limit(args.bots + 256)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,70 +4,131 @@ import tcod.event
 import constants
 
 from components.ui import Input, Button, Menu, Textbox, calculate_middle
-from components import client
+from components import client, log, net_utils
+from components.render import Background, Compositor
+from components.map import TILE_CHARS
 
 # Constants
-from constants import SCREEN_WIDTH, SCREEN_HEIGHT, GAME_TITLE, FONT, FONT_OPTIONS_MASK
+from constants import SCREEN_WIDTH, SCREEN_HEIGHT, GAME_TITLE, FONT
+
+FONT_OPTIONS_MASK = tcod.FONT_TYPE_GREYSCALE | tcod.FONT_LAYOUT_TCOD
+
+# Numpad keys move the character, the arrow keys already scroll the chat
+MOVE_KEYS = {
+    tcod.event.K_KP_8: (0, -1),
+    tcod.event.K_KP_2: (0, 1),
+    tcod.event.K_KP_4: (-1, 0),
+    tcod.event.K_KP_6: (1, 0),
+    tcod.event.K_KP_7: (-1, -1),
+    tcod.event.K_KP_9: (1, -1),
+    tcod.event.K_KP_1: (-1, 1),
+    tcod.event.K_KP_3: (1, 1)
+}
+
+# What the same keys type with num lock on
+KEYPAD_DIGITS = {
+    tcod.event.K_KP_8: '8',
+    tcod.event.K_KP_2: '2',
+    tcod.event.K_KP_4: '4',
+    tcod.event.K_KP_6: '6',
+    tcod.event.K_KP_7: '7',
+    tcod.event.K_KP_9: '9',
+    tcod.event.K_KP_1: '1',
+    tcod.event.K_KP_3: '3'
+}
 
 
 class Game:
 
     def __init__(self, root_console: tcod.console.Console):
         self.root_console = root_console
+        self.background = Background('Logue Regacy')
         self.main_menu = MainMenu(self)
         self.chat_view = ChatView(self)
         self.main_menu.open()
         self.game_client: client.Client = client.Client()
 
+        # Layers are only rendered again after being marked dirty, every other frame they're just blitted
+        self.compositor = Compositor(root_console.width, root_console.height)
+        self.compositor.add_layer('background', self.background.draw, opaque=True)
+        self.compositor.add_layer('world', self.draw_world)
+        self.compositor.add_layer('chat', self.chat_view.draw)
+        self.compositor.add_layer('menu', self.main_menu.draw)
+
     def _run_main_loop(self):
+        skip_text = None
         while True:
             console = self.root_console
 
             tcod.console_flush()
-            console.clear()
-
-            brick_height = 4
-            brick_width = 8
-
-            for x in range(0, SCREEN_WIDTH):
-                for y in range(0, SCREEN_HEIGHT):
-                    console.print(x, y, ' ', bg=(90, 90, 98))
-                    if y % (brick_height + 1) == 0:
-                        console.print(x, y, ' ', bg=(50,50,58))
-                    if y % ((brick_height * 2) + 2) - 2 < (brick_height / 2) + 1:
-                        if x % (brick_width + 1) == 0:
-                            console.print(x, y, ' ', bg=(50, 50, 58))
-                    else:
-                        if x % (brick_width + 1) == (brick_width/2):
-                            console.print(x, y, ' ', bg=(50, 50, 58))
-
-            console.draw_frame(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, clear=False, title='Logue Regacy')
-
-            if self.game_client.connected:
-                self.chat_view.draw(console)
-
-            if self.main_menu.is_open():
-                self.main_menu.menu_stack[-1].draw()
+            self.game_client.process_events()
+            self.compositor.set_visible('world', self.game_client.connected)
+            self.compositor.set_visible('chat', self.game_client.connected)
+            self.compositor.set_visible('menu', self.main_menu.is_open())
+            prediction = self.game_client.prediction
+            if prediction is not None and prediction.animating():
+                self.compositor.mark_dirty('world')
+            # The background covers the whole console, so there's no need to clear it first
+            self.compositor.draw(console)
 
             for event in tcod.event.get():
                 if event.type == "QUIT":
                     if self.game_client.connected:
                         self.game_client.disconnect()
                     exit()
-                if event.type == "KEYDOWN" or event.type == "TEXTINPUT":
+                if event.type == "KEYDOWN":
+                    skip_text = None
+                if event.type == "KEYDOWN" and not self.main_menu.is_open() and event.sym in MOVE_KEYS:
+                    self.game_client.move(*MOVE_KEYS[event.sym])
+                    self.compositor.mark_dirty('world')
+                    # With num lock on the key also types its digit right after, which shouldn't end up in the chat
+                    skip_text = KEYPAD_DIGITS[event.sym]
+                elif event.type == "TEXTINPUT" and event.text == skip_text:
+                    skip_text = None
+                elif event.type == "KEYDOWN" or event.type == "TEXTINPUT":
                     if self.main_menu.is_open():
                         self.main_menu.menu_stack[-1].dispatch(event)
+                        self.compositor.mark_dirty('menu')
                     elif self.chat_view:
                         self.chat_view.message_input.dispatch(event)
                         self.chat_view.message_box.dispatch(event)
+                        self.compositor.mark_dirty('chat')
+
+    def draw_world(self, console):
+        game_map = self.game_client.map
+        if game_map is None:
+            return
+        width = min(game_map.width, console.width - 4)
+        height = min(game_map.height, console.height - 4)
+        # The console is in order F, so indexed [x, y] where the map is indexed [y, x]
+        cells = (slice(2, 2 + width), slice(2, 2 + height))
+        console.ch[cells] = TILE_CHARS[game_map.tiles[:height, :width]].T
+        console.fg[cells] = (200, 200, 200)
+        console.bg[cells] = (0, 0, 0)
+
+        prediction = self.game_client.prediction
+        if prediction is not None:
+            for _, x, y in prediction.entities():
+                x, y = round(x), round(y)
+                if 0 <= x < width and 0 <= y < height:
+                    console.print(2 + x, 2 + y, '@', fg=(255, 255, 255))
+
+    def on_connection_event(self, event):
+        if event[0] in (constants.MAP, constants.MAP_DELTA, constants.PLAYER_RESOLVE, constants.SNAPSHOT):
+            self.compositor.mark_dirty('world')
 
     def start(self):
         self._run_main_loop()
 
     def connect(self, ip, port):
+        self.game_client.name = self.main_menu.player_name_input.text
+        self.game_client.add_event_listener(self)
         self.game_client.add_event_listener(self.chat_view)
         self.game_client.connect(ip, port)
-        self.game_client.send((constants.PLAYER_CONNECT, {'name': self.main_menu.player_name_input.text}))
+        self.game_client.send((constants.PLAYER_CONNECT, {
+            'name': self.game_client.name,
+            'codecs': net_utils.PREFERRED_CODECS
+        }))
         self.main_menu.close()
 
 
@@ -91,7 +152,8 @@ class ChatView:
         self.game.game_client.send((constants.GLOBAL_CHAT, {'message': text}))
 
     def add_message(self, message):
-        self.message_box.add_message(message + '\n')
+        self.message_box.add_message(message)
+        self.game.compositor.mark_dirty('chat')
 
     def on_connection_event(self, event):
         if event[0] == constants.GLOBAL_CHAT:
@@ -130,6 +192,9 @@ class MainMenu:
     def is_open(self):
         return self._menu_open
 
+    def draw(self, console):
+        self.menu_stack[-1].draw(console)
+
     def __init__(self, game: Game):
         self._game = game
 
@@ -206,6 +271,7 @@ def init_tcod() -> tcod.console.Console:
 
 
 def main():
+    log.setup('client.log')
     root_console = init_tcod()
     Game(root_console).start()
 
@@ -0,0 +1,59 @@
+import threading
+import time
+
+import constants as c
+from components.log import get_logger
+
+logger = get_logger('scheduler')
+
+
+class TickScheduler:
+    """Runs the tick of every active session at a fixed rate, all on one thread.
+
+    Sessions only queue up what happens between ticks, the scheduler thread is the one that applies it
+    to their game state. That keeps the work per session per second bounded by the tick rate and gives
+    every game state a single owner.
+    """
+
+    def __init__(self, tick_rate=c.TICK_RATE):
+        self.interval = 1 / tick_rate
+        self.running = False
+        self._sessions = set()
+        self._lock = threading.Lock()
+
+    def add(self, session):
+        with self._lock:
+            self._sessions.add(session)
+
+    def remove(self, session):
+        with self._lock:
+            self._sessions.discard(session)
+
+    def start(self):
+        self.running = True
+        t = threading.Thread(target=self.run, name='tick-scheduler')
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        next_tick = time.monotonic()
+        while self.running:
+            with self._lock:
+                sessions = list(self._sessions)
+            for session in sessions:
+                try:
+                    session.tick()
+                except Exception:
+                    # One broken session shouldn't stop the game for everyone else
+                    logger.exception('session %s failed to tick', session.id)
+
+            next_tick += self.interval
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Running behind, skip the missed ticks instead of trying to catch up all at once
+                next_tick = time.monotonic()
@@ -1,21 +1,58 @@
+import logging
 import uuid
-import json
+import threading
+import time
 import constants as c
 
+from collections import defaultdict, deque
+
+from components import game, metrics
+from components.log import get_logger
+from components.fov import FieldOfView
 from components.map import Map
+from components.pathfinding import Pathfinder
+from components.snapshots import SnapshotHistory
+from components.net_utils import broadcast
+from managers.scheduler import TickScheduler
+
+logger = get_logger('sessions')
+
+LOBBY_ACTIONS = ('host', 'get', 'get-all', 'join', 'ready', 'leave')
 
 
 class SessionManager:
-    sessions = []
+    """Keeps track of all open sessions.
+
+    Sessions are indexed by id, by dungeon and by player, the indexes are only ever changed
+    together under the lock so they stay consistent with each other.
+    """
+
+    def __init__(self):
+        self._init_indexes()
+        self.scheduler = TickScheduler()
+        self.scheduler.start()
+
+    def _init_indexes(self):
+        self.sessions = {}
+        self._dungeon_sessions = defaultdict(set)
+        self._player_sessions = defaultdict(set)
+        self._lock = threading.RLock()
 
     def on_lobby_event(self, player, event):
+        start = time.perf_counter()
+        self._handle_lobby_event(player, event)
+        action = metrics.label(event.get('action'), LOBBY_ACTIONS)
+        metrics.REGISTRY.histogram('lobby_handler_seconds', action).observe(time.perf_counter() - start)
+
+    def _handle_lobby_event(self, player, event):
         if event['action'] == 'host':
             self.host_session(player, event['dungeon_id'])
         elif event['action'] == 'get':
             sessions = self.get_sessions_for_dungeon(event['dungeon_id'])
             player.send((c.LOBBIES, {'response': 'get', "sessions": self._serialize_sessions(sessions)}))
         elif event['action'] == 'get-all':
-            player.send((c.LOBBIES, {'response': 'get-all', "sessions": self._serialize_sessions(self.sessions)}))
+            sessions = list(self.sessions.values())
+            player.send((c.LOBBIES, {'response': 'get-all', "sessions": self._serialize_sessions(sessions)}))
         elif event['action'] == 'join':
             self.join_session(player, event['id'])
         elif event['action'] == 'ready':
@@ -25,81 +62,236 @@ class SessionManager:
 
         self.show_all_sessions_data()
 
+    def on_map_resync(self, player, event):
+        session = self._find_session(player, event['session_id'])
+        if session is not None and player in session.players:
+            session.resync(player, event['version'])
+
     def on_player_intent(self, player, intent):
-        session = self.get_session(intent.id)
-        session.player_intent(player, intent.action)
+        session = self.get_session(intent['id'])
+        if session is not None and player in session.players:
+            session.player_intent(player, intent['action'], intent.get('seq'))
+
+    def on_snapshot_ack(self, player, event):
+        session = self._find_session(player, event['session_id'])
+        if session is not None and player in session.players:
+            session.ack_snapshot(player, event['tick'])
 
     def get_session(self, session_id):
-        for s in self.sessions:
-            if s.id is session_id:
-                return s
+        return self.sessions.get(session_id)
 
     def get_sessions_for_dungeon(self, dungeon_id):
-        sessions = []
-        for s in self.sessions:
-            if s.dungeon_id is dungeon_id:
-                sessions.append(s)
-        if not sessions:
-            return None
-        return sessions
+        return list(self._dungeon_sessions.get(dungeon_id, ()))
 
     def get_sessions_for_player(self, player):
-        sessions = []
-        for s in self.sessions:
-            for p in s.players:
-                if p is player:
-                    sessions.append(s)
-        if not sessions:
-            return None
-        return sessions
+        return list(self._player_sessions.get(player, ()))
 
-    def host_session(self, player, dungeon_id):
-        session = Session(player, dungeon_id)
-        self.sessions.append(session)
+    def host_session(self, player, dungeon_id, session_id=None):
+        with self._lock:
+            session = self._create_session(player, dungeon_id, session_id)
+            if session is None:
+                return None
+            self.sessions[session.id] = session
+            self._dungeon_sessions[dungeon_id].add(session)
+            self._player_sessions[player].add(session)
+            return session
 
     def join_session(self, player, session_id):
-        session = self.get_session(session_id)
-        session.join(player)
+        with self._lock:
+            session = self._find_session(player, session_id)
+            if session is None or player in session.players:
+                return
+            session.join(player)
+            self._player_sessions[player].add(session)
 
     def ready_session(self, player, session_id, value):
-        session = self.get_session(session_id)
-        session.ready(player, value)
+        # Locked so a session the last player just left isn't handed back to the scheduler
+        with self._lock:
+            session = self._find_session(player, session_id)
+            if session is not None and player in session.players:
+                session.ready(player, value)
+                if session.started and self.scheduler is not None:
+                    self.scheduler.add(session)
 
     def leave_session(self, player, session_id):
+        with self._lock:
+            session = self._find_session(player, session_id)
+            if session is not None and player in session.players:
+                self._leave(player, session)
+
+    def remove_player(self, player):
+        """Take a disconnected player out of every session they were in."""
+        with self._lock:
+            for session in self.get_sessions_for_player(player):
+                self._leave(player, session)
+
+    def _find_session(self, player, session_id):
         session = self.get_session(session_id)
+        if session is None:
+            player.send((c.LOBBIES, {'message': 'Session %s does not exist' % session_id}))
+        return session
+
+    def _leave(self, player, session):
         session.leave(player)
+        self._discard(self._player_sessions, player, session)
         if not session.players:
-            self.sessions.remove(player)
+            self._remove_session(session)
+
+    def _create_session(self, player, dungeon_id, session_id):
+        return Session(player, dungeon_id, session_id)
+
+    def _remove_session(self, session):
+        self.scheduler.remove(session)
+        del self.sessions[session.id]
+        self._discard(self._dungeon_sessions, session.dungeon_id, session)
+
+    @staticmethod
+    def _discard(index, key, session):
+        sessions = index.get(key)
+        if sessions is not None:
+            sessions.discard(session)
+            if not sessions:
+                del index[key]
 
     def _serialize_sessions(self, sessions):
         result = []
         for s in sessions:
             result.append(s.serialize())
-        return json.dumps(result)
+        return result
 
     def show_all_sessions_data(self):
-        for s in self.sessions:
-            print(s.serialize)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('sessions: %s', self._serialize_sessions(list(self.sessions.values())))
 
 
 class Session:
-    players = []
 
-    def __init__(self, player, dungeon_id):
-        self.id = uuid.uuid1()
+    def __init__(self, player, dungeon_id, session_id=None):
+        # A string so ids coming back over the network can be looked up directly
+        self.id = session_id or str(uuid.uuid1())
+        self.players = []
         self.dungeon_id = dungeon_id
-        self.map = Map(dungeon_id)
+        self.map = Map(dungeon_id, self.id)
+        # The map version each player has been brought up to
+        self.map_versions = {}
+        # Changed tiles each player hasn't seen yet, sent once they come into view
+        self._pending_tiles = {}
+        self.fov = FieldOfView(self.map)
+        self._paths = None
+        # What each player was last sent of the characters around them, see send_snapshots
+        self.snapshots = {}
+
+        # Owned by the scheduler thread once the game has started, see tick
+        self.state = game.GameState(self.map)
+        self.characters = {}
+        self.started = False
+        self.ticks = 0
+        # Intents waiting to be applied by player, filled by the network threads and emptied by tick
+        self._intents = {}
+        self._intents_lock = threading.Lock()
+
         self.join(player)
 
+    @property
+    def paths(self) -> Pathfinder:
+        """Distance fields on the session's map, only built for sessions that use them."""
+        if self._paths is None:
+            self._paths = Pathfinder(self.map)
+        return self._paths
+
     def join(self, player):
         self.players.append(player)
-        player.send((c.MAP, self.map.serialize()))
+        self.map_versions[player] = self.map.version
+        self.snapshots[player] = SnapshotHistory()
+        player.send_frame(self.map.encode(player.codec))
         self.send_to_all((c.LOBBIES, {'message': player.name + ' joined'}))
 
     def leave(self, player):
         self.players.remove(player)
+        self.map_versions.pop(player, None)
+        self._pending_tiles.pop(player, None)
+        self.snapshots.pop(player, None)
+        with self._intents_lock:
+            self._intents.pop(player, None)
         self.send_to_all((c.LOBBIES, {'message': player.name + ' left'}))
 
+    def set_tiles(self, tiles):
+        """Change a batch of (x, y, tile id) tiles and send the changes to everyone in the session."""
+        for x, y, tile in tiles:
+            self.map.set_tile(x, y, tile)
+        self.sync_map()
+
+    def sync_map(self):
+        """Bring every player up to the current map version.
+
+        Once the game has started players only get the changed tiles they can see, the others are
+        held back until they come into view. Players getting the same tiles share one encoded delta.
+        """
+        deltas = defaultdict(list)
+        full = []
+        # Copied since players join and leave on other threads while the scheduler syncs
+        for player, version in list(self.map_versions.items()):
+            visible = self.visible_tiles(player)
+            pending = self._pending_tiles.get(player)
+            if version == self.map.version and (visible is None or not pending):
+                continue
+
+            changed = self.map.changes_since(version)
+            if changed is None:
+                full.append(player)
+                continue
+            if visible is not None:
+                pending = self._pending_tiles.setdefault(player, set())
+                pending |= changed
+                changed = {(x, y) for x, y in pending if visible[y, x]}
+                pending -= changed
+            if changed or version != self.map.version:
+                deltas[version, frozenset(changed)].append(player)
+
+        for (version, tiles), players in deltas.items():
+            broadcast(players, (c.MAP_DELTA, self.map.tile_delta(version, tiles)))
+            self._update_map_versions(players)
+        if full:
+            self._send_full_map(full)
+
+    def resync(self, player, version):
+        """Send a player everything they're missing, including tiles held back while out of view."""
+        changed = self.map.changes_since(version)
+        if changed is None:
+            self._send_full_map([player])
+        else:
+            changed |= self._pending_tiles.pop(player, set())
+            player.send((c.MAP_DELTA, self.map.tile_delta(version, changed)))
+            self._update_map_versions([player])
+
+    def _send_full_map(self, players):
+        for player in players:
+            player.send_frame(self.map.encode(player.codec))
+            self._pending_tiles.pop(player, None)
+        self._update_map_versions(players)
+
+    def _update_map_versions(self, players):
+        for player in players:
+            if player in self.map_versions:
+                self.map_versions[player] = self.map.version
+
+    def visible_tiles(self, player):
+        """Return the field of view of the player's character, None while they don't have one."""
+        character = self.characters.get(player)
+        if character is None:
+            return None
+        return self.fov.visible(character.entity.x, character.entity.y)
+
+    def _seen_players(self):
+        """Return the ids of the characters each player can see, their own included."""
+        ids = {character.entity: character.id for character in self.characters.values()}
+        seen = {}
+        for player, character in list(self.characters.items()):
+            entity = character.entity
+            visible = self.state.entities_in_view(self.visible_tiles(player), entity.x, entity.y, self.fov.radius)
+            seen[player] = {ids[e] for e in visible if e in ids} | {character.id}
+        return seen
+
     def ready(self, player, value):
         player.is_ready = value
 
@@ -116,24 +308,128 @@ class Session:
         self._start()
 
     def _start(self):
+        if self.started:
+            return
+        self.started = True
         self.send_to_all((c.LOBBIES, {'start': 'True'}))
 
-    def player_intent(self, player, action):
-        print("player intent")
-        # TODO: handle action
-        # Do stuff
-        # resolve_action(result)
+    def player_intent(self, player, action, seq=None):
+        # Nothing would ever take them off the queue before the game starts
+        if not self.started or player not in self.players or not isinstance(action, dict):
+            return
+        # Only queued here, it's applied together with everything else that came in during the tick
+        with self._intents_lock:
+            queue = self._intents.setdefault(player, deque())
+            if len(queue) >= c.MAX_QUEUED_INTENTS:
+                logger.debug('dropped an intent of %s, too many queued', player.name)
+                return
+            queue.append((game.Action(action.get('type'), action.get('value')), seq))
+
+    def tick(self):
+        """Advance the game by one step, called by the scheduler at the session's tick rate.
+
+        Players are told the results of their own actions and the sequence number of the last intent
+        of theirs that was applied, so predicting clients know which of their moves are settled.
+        Everything else they see reaches them through the snapshots.
+        """
+        self.ticks += 1
+        joined = self._sync_characters()
+
+        actions = []
+        acks = {}
+        for player, action, seq in self._take_intents():
+            character = self.characters.get(player)
+            if character is not None:
+                actions.append((character, action))
+                if seq is not None:
+                    acks[character.id] = seq
+
+        if actions or joined:
+            results = [self._spawn(character) for character in joined]
+            if actions:
+                results += self.state.resolve(actions)
+            self.resolve_action({'tick': self.state.turncount, 'results': results, 'acks': acks})
+        self.sync_map()
+        self.send_snapshots()
+
+    def _take_intents(self):
+        """Take the intents to apply this tick, every player's up to and including their first move.
+
+        A character only takes one step per tick, so moves sent faster than that wait for the next ones.
+        """
+        taken = []
+        with self._intents_lock:
+            for player, queue in list(self._intents.items()):
+                while queue:
+                    action, seq = queue.popleft()
+                    taken.append((player, action, seq))
+                    if action.type == 'MOVE':
+                        break
+                if not queue:
+                    del self._intents[player]
+        return taken
+
+    def send_snapshots(self):
+        """Send every player the state of the characters they can see, as changes since what they acknowledged.
+
+        Players whose view didn't change since the last snapshot get nothing, so an idle session sends nothing.
+        """
+        world = {character.id: {'x': character.entity.x, 'y': character.entity.y, 'char': character.entity.char}
+                 for character in self.characters.values()}
+        for player, seen in self._seen_players().items():
+            history = self.snapshots.get(player)
+            if history is None:
+                continue
+            payload = history.delta(self.ticks, {character_id: world[character_id] for character_id in seen})
+            if payload is not None:
+                payload['session_id'] = self.id
+                player.send((c.SNAPSHOT, payload))
+
+    def ack_snapshot(self, player, tick):
+        history = self.snapshots.get(player)
+        if history is not None:
+            history.ack(tick)
+
+    def _sync_characters(self):
+        """Create and remove characters for the players that joined and left, returns the new ones."""
+        joined = []
+        players = list(self.players)
+        for player in players:
+            if player not in self.characters:
+                self.characters[player] = character = game.Player(player.name, (255, 255, 255), player.id)
+                self.state.add_player(character)
+                joined.append(character)
+        for player in list(self.characters):
+            if player not in players:
+                self.state.remove_player(self.characters.pop(player))
+        return joined
+
+    @staticmethod
+    def _spawn(character):
+        return {'player': character.id, 'type': 'SPAWN', 'ok': True, 'x': character.entity.x, 'y': character.entity.y}
 
     def resolve_action(self, result):
-        self.send_to_all((c.PLAYER_RESOLVE, result))
+        """Send every player the results of their own actions, and their ack if they have one."""
+        own = defaultdict(list)
+        for r in result['results']:
+            own[r['player']].append(r)
+
+        for player, character in list(self.characters.items()):
+            results = own.get(character.id, [])
+            ack = result['acks'].get(character.id)
+            if results or ack is not None:
+                player.send((c.PLAYER_RESOLVE, {
+                    'tick': result['tick'],
+                    'results': results,
+                    'acks': {} if ack is None else {character.id: ack}
+                }))
 
     def serialize(self):
-        return json.dumps({
+        return {
             'id': self.id,
             'dungeon_id': self.dungeon_id,
             'players': [p.name for p in self.players]
-        })
+        }
 
-    def send_to_all(self, message):
-        for p in self.players:
-            p.send(message)
+    def send_to_all(self, message, exclude=()):
+        broadcast(self.players, message, exclude)
@@ -0,0 +1,257 @@
+'''Shards module running sessions on a pool of worker processes
+
+The server process keeps handling connections, chat and the lobby, while the sessions themselves
+(map, game state and tick loop) each live on one of the worker processes. Messages for a session
+are forwarded to its worker over a pipe, and the frames the worker wants to send come back the
+same way, already encoded.
+'''
+
+import multiprocessing
+import threading
+import time
+import uuid
+
+import constants as c
+from components.log import get_logger
+from components.net_utils import CODECS, encode
+from managers.sessions import SessionManager
+
+logger = get_logger('shards')
+
+# A crashed worker is restarted after RESTART_DELAY seconds, doubled for every crash that follows
+# soon after the last start, and given up on after MAX_RESTARTS of those in a row
+RESTART_DELAY = 1
+MAX_RESTARTS = 5
+# Seconds a worker has to keep running for a crash not to count as one in a row
+STABLE_AFTER = 60
+
+
+class RemotePlayer:
+    """Stand-in for a connected player on a worker, sending everything back to the server process."""
+
+    def __init__(self, player_id, name, codec, conn, lock):
+        self.id = player_id
+        self.name = name
+        self.codec = CODECS[codec]
+        self.is_ready = False
+        self._conn = conn
+        self._lock = lock
+
+    def send(self, msg):
+        self.send_frame(encode(msg, self.codec))
+
+    def send_frame(self, frame):
+        with self._lock:
+            self._conn.send((self.id, frame))
+
+
+def run_shard(conn):
+    """Worker process main loop, running the sessions placed on it with a regular SessionManager."""
+    manager = SessionManager()
+    players = {}
+    lock = threading.Lock()
+
+    while True:
+        try:
+            command, player_id, *args = conn.recv()
+        except (EOFError, OSError):
+            # The server is gone, nobody left to play with
+            return
+
+        if command in ('host', 'join'):
+            name, codec, *args = args
+            player = players.get(player_id)
+            if player is None:
+                player = players[player_id] = RemotePlayer(player_id, name, codec, conn, lock)
+        else:
+            player = players.get(player_id)
+            if player is None:
+                continue
+
+        try:
+            if command == 'host':
+                manager.host_session(player, *args)
+            elif command == 'join':
+                manager.join_session(player, *args)
+            elif command == 'ready':
+                manager.ready_session(player, *args)
+            elif command == 'leave':
+                manager.leave_session(player, *args)
+                if not manager.get_sessions_for_player(player):
+                    del players[player_id]
+            elif command == 'intent':
+                manager.on_player_intent(player, *args)
+            elif command == 'resync':
+                manager.on_map_resync(player, *args)
+            elif command == 'ack':
+                manager.on_snapshot_ack(player, *args)
+        except Exception:
+            # A bad message shouldn't take down every session on the worker
+            logger.exception('shard failed to handle %s', command)
+
+
+class Shard:
+    """A worker process and the pipe to it, read by a thread handing the frames to the players."""
+
+    def __init__(self, manager, index):
+        self.manager = manager
+        self.index = index
+        self.sessions = set()
+        self.process = None
+        self.running = False
+        self.restarts = 0
+        self.started_at = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Spawned rather than forked, the server process is full of threads
+        context = multiprocessing.get_context('spawn')
+        self._conn, child_conn = context.Pipe()
+        self.process = context.Process(target=run_shard, args=(child_conn,), name='shard-%d' % self.index)
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.running = True
+        self.started_at = time.monotonic()
+
+        t = threading.Thread(target=self.read, args=(self._conn,), name='shard-%d-reader' % self.index)
+        t.daemon = True
+        t.start()
+
+    def send(self, command):
+        try:
+            with self._lock:
+                self._conn.send(command)
+        except (OSError, ValueError):
+            # Crashed, the reader thread takes care of cleaning up
+            pass
+
+    def read(self, conn):
+        while True:
+            try:
+                player_id, frame = conn.recv()
+            except (EOFError, OSError):
+                break
+            player = self.manager.get_player(player_id)
+            if player is not None:
+                player.send_frame(frame)
+        conn.close()
+        self.manager.on_shard_crash(self)
+
+
+class RemoteSession:
+    """Lobby side record of a session running on a shard, forwarding everything to it."""
+
+    def __init__(self, manager, shard, player, dungeon_id, session_id):
+        self.manager = manager
+        self.shard = shard
+        self.id = session_id
+        self.dungeon_id = dungeon_id
+        self.players = [player]
+        self.started = False
+
+    def join(self, player):
+        self.players.append(player)
+        self.shard.send(('join', self.manager.player_id(player), player.name, player.codec.name, self.id))
+
+    def leave(self, player):
+        self.players.remove(player)
+        self.shard.send(('leave', self.manager.player_id(player), self.id))
+
+    def ready(self, player, value):
+        player.is_ready = value
+        self.shard.send(('ready', self.manager.player_id(player), self.id, value))
+
+    def resync(self, player, version):
+        self.shard.send(('resync', self.manager.player_id(player), {'session_id': self.id, 'version': version}))
+
+    def player_intent(self, player, action, seq=None):
+        self.shard.send(('intent', self.manager.player_id(player), {'id': self.id, 'action': action, 'seq': seq}))
+
+    def ack_snapshot(self, player, tick):
+        self.shard.send(('ack', self.manager.player_id(player), {'session_id': self.id, 'tick': tick}))
+
+    def serialize(self):
+        return {
+            'id': self.id,
+            'dungeon_id': self.dungeon_id,
+            'players': [p.name for p in self.players]
+        }
+
+
+class ShardedSessionManager(SessionManager):
+    """SessionManager placing every session on the least busy of a pool of worker processes.
+
+    The lobby still knows every session so listings are complete, but a busy dungeon only slows
+    down the sessions sharing its worker. A worker that crashes takes its own sessions down with
+    it, their players are told and the worker is replaced.
+    """
+
+    def __init__(self, shards=2):
+        self._init_indexes()
+        # Sessions tick on the workers
+        self.scheduler = None
+
+        # Connected players by their id, which is what the workers know them by
+        self._players = {}
+
+        self.shards = [Shard(self, i) for i in range(shards)]
+        for shard in self.shards:
+            shard.start()
+
+    def player_id(self, player):
+        with self._lock:
+            self._players[player.id] = player
+            return player.id
+
+    def get_player(self, player_id):
+        return self._players.get(player_id)
+
+    def remove_player(self, player):
+        with self._lock:
+            super().remove_player(player)
+            self._players.pop(player.id, None)
+
+    def _create_session(self, player, dungeon_id, session_id):
+        running = [shard for shard in self.shards if shard.running]
+        if not running:
+            player.send((c.LOBBIES, {'message': 'No worker to run the session on, try again later'}))
+            return None
+        shard = min(running, key=lambda s: len(s.sessions))
+        session = RemoteSession(self, shard, player, dungeon_id, session_id or str(uuid.uuid1()))
+        shard.sessions.add(session)
+        shard.send(('host', self.player_id(player), player.name, player.codec.name, dungeon_id, session.id))
+        return session
+
+    def _remove_session(self, session):
+        session.shard.sessions.discard(session)
+        del self.sessions[session.id]
+        self._discard(self._dungeon_sessions, session.dungeon_id, session)
+
+    def on_shard_crash(self, shard):
+        shard.process.join(1)
+        logger.warning('shard %d stopped with exit code %s', shard.index, shard.process.exitcode)
+        with self._lock:
+            shard.running = False
+            for session in list(shard.sessions):
+                for player in list(session.players):
+                    player.send((c.LOBBIES, {'message': 'Session %s crashed' % session.id}))
+                    session.players.remove(player)
+                    self._discard(self._player_sessions, player, session)
+                self._remove_session(session)
+
+            if time.monotonic() - shard.started_at > STABLE_AFTER:
+                shard.restarts = 0
+            if shard.restarts >= MAX_RESTARTS:
+                logger.error('shard %d crashed %d times in a row, not restarting it', shard.index, shard.restarts)
+                self.shards.remove(shard)
+                return
+            delay = RESTART_DELAY * 2 ** shard.restarts
+            shard.restarts += 1
+
+        # Called on the reader thread of the crashed shard, nothing else is waiting for it
+        logger.info('restarting shard %d in %g seconds', shard.index, delay)
+        time.sleep(delay)
+        with self._lock:
+            shard.start()
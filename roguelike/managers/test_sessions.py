@@ -0,0 +1,106 @@
+import unittest
+
+import constants as c
+from components import game
+from components.map import FLOOR, WALL
+from components.net_utils import HEADER, JSON, decode_message, encode
+from managers.sessions import Session
+
+# Behind the wall of the room in the top left corner
+HIDDEN = (9, 2)
+
+
+class FakePlayer:
+
+    def __init__(self, name):
+        self.name = name
+        self.id = name
+        self.codec = JSON
+        self.is_ready = False
+        self.frames = []
+
+    def send(self, message):
+        self.send_frame(encode(message, self.codec))
+
+    def send_frame(self, frame):
+        self.frames.append(frame)
+
+    def received(self, event):
+        messages = [decode_message(frame[HEADER.size:]) for frame in self.frames]
+        return [payload for message_event, payload in messages if message_event == event]
+
+
+class MapSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.a, self.b = FakePlayer('a'), FakePlayer('b')
+        self.session = Session(self.a, 'test')
+        self.session.join(self.b)
+        self.a.frames.clear()
+        self.b.frames.clear()
+
+    def place(self, player, x, y):
+        character = self.session.characters.get(player)
+        if character is None:
+            character = self.session.characters[player] = game.Player(player.name, (255, 255, 255), player.id)
+        character.entity.x, character.entity.y = x, y
+
+    def test_changes_share_one_frame(self):
+        self.session.set_tiles([(*HIDDEN, WALL)])
+        self.assertEqual(len(self.a.frames), 1)
+        self.assertIs(self.a.frames[0], self.b.frames[0])
+        delta = self.a.received(c.MAP_DELTA)[0]
+        self.assertEqual((delta['from'], delta['version'], delta['tiles']), (0, 1, [[9, 2, '#']]))
+        self.assertEqual(self.session.map_versions, {self.a: 1, self.b: 1})
+
+    def test_nothing_new_sends_nothing(self):
+        self.session.set_tiles([(*HIDDEN, FLOOR)])
+        self.session.sync_map()
+        self.assertEqual(self.a.frames, [])
+
+    def test_resync(self):
+        self.session.map.set_tile(*HIDDEN, WALL)
+        self.session.map.set_tile(1, 1, WALL)
+        self.session.resync(self.a, 1)
+        self.assertEqual(self.a.received(c.MAP_DELTA)[0]['tiles'], [[1, 1, '#']])
+        self.assertEqual(self.session.map_versions[self.a], 2)
+
+    def test_resync_too_far_behind_sends_the_map(self):
+        for _ in range(self.session.map._changes.maxlen // 2 + 1):
+            self.session.map.set_tile(*HIDDEN, WALL)
+            self.session.map.set_tile(*HIDDEN, FLOOR)
+        self.session.resync(self.a, 0)
+        self.assertEqual(self.a.received(c.MAP_DELTA), [])
+        self.assertEqual(self.a.received(c.MAP)[0]['version'], self.session.map.version)
+
+    def test_out_of_view_tiles_wait(self):
+        self.place(self.a, 2, 2)
+        self.session.set_tiles([(*HIDDEN, WALL)])
+        # The version moves on, the tile stays hidden
+        delta = self.a.received(c.MAP_DELTA)[0]
+        self.assertEqual((delta['version'], delta['tiles']), (1, []))
+        # b doesn't have a character yet and sees everything
+        self.assertEqual(self.b.received(c.MAP_DELTA)[0]['tiles'], [[9, 2, '#']])
+
+        self.a.frames.clear()
+        self.session.sync_map()
+        self.assertEqual(self.a.frames, [])
+
+        self.place(self.a, 9, 3)
+        self.session.sync_map()
+        delta = self.a.received(c.MAP_DELTA)[0]
+        self.assertEqual((delta['from'], delta['version'], delta['tiles']), (1, 1, [[9, 2, '#']]))
+
+        self.a.frames.clear()
+        self.session.sync_map()
+        self.assertEqual(self.a.frames, [])
+
+    def test_resync_includes_held_back_tiles(self):
+        self.place(self.a, 2, 2)
+        self.session.set_tiles([(*HIDDEN, WALL)])
+        self.session.resync(self.a, 1)
+        self.assertEqual(self.a.received(c.MAP_DELTA)[-1]['tiles'], [[9, 2, '#']])
+
+
+if __name__ == '__main__':
+    unittest.main()
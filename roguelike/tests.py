@@ -3,6 +3,7 @@ import tcod.console
 import tcod.event
 
 from components import particle
+from components.ui import Typewriter
 
 # Constants
 SCREEN_WIDTH = 160
@@ -62,7 +63,7 @@ def game_loop(console):
     emitter = particle.Emitter(console, mist, 1, SCREEN_HEIGHT - 1, SCREEN_WIDTH - 23, 1)
     lantern = particle.Emitter(console, lantern, 1540 // 12, 816 // 12, 3, 1)
     rain = particle.Emitter(console, rain, 1, 0, SCREEN_WIDTH - 2, 1, rate=3)
-    bee = open('assets/bee.txt').read()
+    bee = Typewriter(open('assets/bee.txt').read(), SCREEN_WIDTH - 64)
     wiz = tcod.image_load('assets/wizard_idle_dark.bmp')
     # wiz.set_key_color((0, 0, 0))
     i = 20
@@ -86,7 +87,7 @@ def game_loop(console):
         )
 
         wiz.blit(console, SCREEN_WIDTH - 32, SCREEN_HEIGHT // 2, tcod.BKGND_SCREEN, 1.5, 1.5, 0)
-        console.print_box(3, 3, SCREEN_WIDTH - 64, SCREEN_HEIGHT - 3, bee[0:i], fg=(217, 130, 67))
+        bee.draw(console, 3, 3, i, fg=(217, 130, 67))
         console.print(SCREEN_WIDTH - 2, 1, str(chr(30)), fg=(252, 149, 71))
         console.print(SCREEN_WIDTH - 2, SCREEN_HEIGHT - 2, str(chr(31)), fg=(252, 149, 71))
         console.print(SCREEN_WIDTH - 8, 1, str(tcod.sys_get_fps()), fg=(230, 230, 230))